@@ -0,0 +1,240 @@
+import asyncio
+import collections
+
+from common import JsonRpc, MessageFramer
+
+
+async def start_tool_async(langserv):
+    ''' Start the language server, return an asyncio Process object. '''
+
+    cmd = '{}'.format(langserv)
+    return await asyncio.create_subprocess_shell(
+        cmd, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
+
+
+async def connect_tool_async(address):
+    ''' Connect to a server listening on ADDRESS (see
+    common.socket_address), return a (reader, writer) pair of asyncio
+    streams.  '''
+
+    if isinstance(address, str):
+        return await asyncio.open_unix_connection(address)
+
+    return await asyncio.open_connection(*address)
+
+
+class AsyncJsonRpc(JsonRpc):
+    ''' asyncio flavor of JsonRpc.
+
+    A reader task continuously decodes messages from the server.  Responses
+    resolve the future of the matching request, notifications are queued by
+    method until someone waits for them.  The message encoding and the
+    request objects are the same as for JsonRpc.  '''
+
+    def __init__(self, writer, reader, log, log_pretty, logger=None):
+        super().__init__(writer, reader, log, log_pretty, logger=logger)
+        # Futures waiting for a message, keyed like JsonRpc._inbox.
+        self._futures = collections.defaultdict(collections.deque)
+        self._closed = None
+        self._reader_task = asyncio.ensure_future(self._read_loop())
+
+    async def _read_loop(self):
+        try:
+            while True:
+                body = self._framer.next_body()
+                if body is None:
+                    chunk = await self._input.read(MessageFramer.READ_SIZE)
+                    if not chunk:
+                        raise EOFError('connection to the server was closed')
+
+                    self._framer.feed(chunk)
+                    continue
+
+                if self._logger is not None:
+                    self._logger.log(body, 'server')
+
+                if self.recorder is not None:
+                    self.recorder.record(body, 'server')
+
+                json_data = self._decode(body, self._framer.last_charset)
+                self._record_reply(json_data, body)
+                self.dispatch(json_data)
+        except Exception as e:
+            self._closed = e
+            for waiters in self._futures.values():
+                for fut in waiters:
+                    if not fut.done():
+                        fut.set_exception(e)
+            self._futures.clear()
+
+    def dispatch(self, json_data):
+        key = self.message_key(json_data)
+        if key is None:
+            return
+
+        if self._run_handlers(key, json_data):
+            return
+
+        if self._deadlines:
+            self._deadlines.pop(key, None)
+
+        if key in self._cancelled:
+            self._cancelled.discard(key)
+            return
+
+        waiters = self._futures.get(key)
+        while waiters:
+            fut = waiters.popleft()
+            if not fut.done():
+                fut.set_result(json_data)
+                return
+
+        self._enqueue(key, json_data)
+
+    def _send(self, buffers):
+        self._output.writelines(buffers)
+
+    async def _drain(self):
+        await self._output.drain()
+
+    def pull_one_message(self):
+        raise RuntimeError(
+            'messages are read by the reader task, use wait_for')
+
+    async def wait_for(self, pending):
+        key = pending.key()
+
+        json_data = self._take(key)
+        if json_data is not None:
+            return pending.extract(json_data)
+
+        if self._closed is not None:
+            raise self._closed
+
+        fut = asyncio.get_running_loop().create_future()
+        self._futures[key].append(fut)
+
+        try:
+            json_data = await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # Cancelled after the message was dispatched to us: keep it
+                # for whoever waits for it next.
+                self._inbox.setdefault(
+                    key, collections.deque()).appendleft(fut.result())
+            raise
+
+        return pending.extract(json_data)
+
+    async def stream(self, req, timeout=None):
+        ''' Async generator flavor of JsonRpc.stream.  '''
+
+        token = 'partial-{}'.format(next(self._partial_tokens))
+        req.partial_result_token = token
+        chunks = asyncio.Queue()
+
+        def on_progress(json_data):
+            params = json_data.get('params') or {}
+            if params.get('token') != token:
+                return False
+
+            chunks.put_nowait((False, params.get('value')))
+            return True
+
+        progress_key = ('method', '$/progress')
+        self.add_handler(progress_key, on_progress)
+
+        pending, frame = self._prepare_request(req, timeout)
+        task = asyncio.ensure_future(self._request(pending, frame))
+        task.add_done_callback(lambda t: chunks.put_nowait((True, t)))
+
+        try:
+            while True:
+                is_final, value = await chunks.get()
+                if is_final:
+                    value = value.result()
+                if value:
+                    yield value
+                if is_final:
+                    return
+        finally:
+            self.remove_handler(progress_key, on_progress)
+            if not task.done():
+                # Closed early: tell the server, as JsonRpc.stream does.
+                task.cancel()
+                self._abandon(pending.key(), pending._id)
+
+    def _arm(self, key, the_id, method_name, timeout):
+        # The event loop is our scheduler, see request.
+        self._deadlines[key] = (the_id, method_name, timeout)
+
+    async def request(self, req, timeout=None, decoder=None):
+        ''' Send REQ and return its result.
+
+        If the reply doesn't arrive within TIMEOUT seconds (default:
+        default_timeout), the request is cancelled and RequestTimeout is
+        raised.  See JsonRpc.request for DECODER.  '''
+
+        pending, frame = self._prepare_request(req, timeout, decoder)
+        return await self._request(pending, frame)
+
+    async def _request(self, pending, frame):
+        self._send(frame)
+        await self._drain()
+
+        key = pending.key()
+        if key not in self._deadlines:
+            return await self.wait_for(pending)
+
+        try:
+            return await asyncio.wait_for(self.wait_for(pending),
+                                          self._deadlines[key][2])
+        except asyncio.TimeoutError:
+            self._expire(key)
+            await self._drain()
+            error = self._expired.pop(key, None)
+            if error is None:
+                # The reply was dispatched as the deadline passed.
+                return pending.extract(self._take(key))
+            raise error
+
+    async def request_many(self, reqs, window=None, timeout=None):
+        reqs = list(reqs)
+        if window is None:
+            window = max(len(reqs), 1)
+
+        assert window > 0
+
+        sem = asyncio.Semaphore(window)
+
+        async def one(req):
+            async with sem:
+                return await self.request(req, timeout)
+
+        return await asyncio.gather(*[one(req) for req in reqs])
+
+    async def gather(self, pendings):
+        return await asyncio.gather(*[self.wait_for(p) for p in pendings])
+
+    async def notify(self, notif):
+        super().notify(notif)
+        await self._drain()
+
+    async def notifications(self, method_name):
+        ''' Asynchronously iterate over the notifications for METHOD_NAME, as
+        they arrive.  '''
+
+        pending = JsonRpc.JsonRpcPendingMethod(method_name)
+
+        while True:
+            try:
+                yield await self.wait_for(pending)
+            except EOFError:
+                return
+
+    async def close(self):
+        self._reader_task.cancel()
+        try:
+            await self._reader_task
+        except asyncio.CancelledError:
+            pass
@@ -0,0 +1,66 @@
+#
+# Micro-benchmark of the JSON codecs on realistic payloads: a references
+# reply and a workspace/symbol reply, as a clangd response would look.
+#
+# Run with: python3 bench_codec.py [--locations N] [--symbols N]
+#
+
+import argparse
+import time
+
+import common
+import stub_server
+
+
+def make_reply(result):
+    return {'jsonrpc': '2.0', 'id': 123, 'result': result}
+
+
+def bench(fn, arg, min_time=0.5):
+    ''' Return the average time of one call to FN(ARG).  '''
+
+    n = 0
+    start = time.perf_counter()
+    while True:
+        fn(arg)
+        n += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return elapsed / n
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--locations', type=int, default=50000,
+                           help='number of locations in the references reply')
+    argparser.add_argument('--symbols', type=int, default=20000,
+                           help='number of symbols in the symbol reply')
+    args = argparser.parse_args()
+
+    payloads = {
+        'references': make_reply(stub_server.make_locations(args.locations)),
+        'workspace/symbol': make_reply(stub_server.make_symbols(args.symbols)),
+    }
+
+    codecs = []
+    for name in common.CODECS:
+        try:
+            codecs.append(common.make_codec(name))
+        except ImportError:
+            print('{} is not installed, skipping'.format(name))
+
+    for payload_name, obj in payloads.items():
+        data = common.StdlibJsonCodec().dumps(obj)
+        print('{} ({} bytes):'.format(payload_name, len(data)))
+
+        for codec in codecs:
+            encode = bench(codec.dumps, obj)
+            decode = bench(codec.loads, data)
+            print('  {:8} encode {:8.2f} ms  {:7.1f} MB/s   '
+                  'decode {:8.2f} ms  {:7.1f} MB/s'.format(
+                      codec.name, encode * 1000, len(data) / encode / 1e6,
+                      decode * 1000, len(data) / decode / 1e6))
+
+
+if __name__ == '__main__':
+    main()
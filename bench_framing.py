@@ -0,0 +1,127 @@
+#
+# Throughput benchmark for the client-side message framing.
+#
+# A local stand-in server writes a burst of pre-encoded messages as fast as
+# it can, and we measure how fast JsonRpc.pull_one_message consumes them.
+#
+# Run with: python3 bench_framing.py [--count N] [--size BYTES] [--transport pipe|socket|socket-recv-into] [--json-codec NAME]
+#
+
+import argparse
+import json
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import common
+
+
+def make_frames(count, size):
+    ''' Build COUNT publishDiagnostics-like notifications, each with a body of
+    roughly SIZE bytes.  '''
+
+    filler = 'x' * max(0, size - 100)
+    obj = {
+        'jsonrpc': '2.0',
+        'method': 'textDocument/publishDiagnostics',
+        'params': {'uri': 'file:///bench.cpp', 'filler': filler},
+    }
+    body = json.dumps(obj).encode()
+    header = 'Content-Length: {}\r\n\r\n'.format(len(body)).encode()
+    return (header + body) * count, len(body)
+
+
+# Code run by the stand-in server process: dump stdin to stdout.
+PIPE_SERVER = ('import shutil, sys; '
+               'shutil.copyfileobj(sys.stdin.buffer, sys.stdout.buffer)')
+
+
+def bench_pipe(data, count, codec):
+    server = subprocess.Popen([sys.executable, '-c', PIPE_SERVER],
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def feed():
+        server.stdin.write(data)
+        server.stdin.close()
+
+    t = threading.Thread(target=feed)
+    t.start()
+
+    json_rpc = common.JsonRpc(None, server.stdout, False, False)
+    json_rpc.codec = codec
+    elapsed = consume(json_rpc, count)
+
+    t.join()
+    server.wait()
+    return elapsed
+
+
+def bench_socket(data, count, transport, codec):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    port = listener.getsockname()[1]
+
+    def serve():
+        conn, _ = listener.accept()
+        conn.sendall(data)
+        conn.close()
+
+    t = threading.Thread(target=serve)
+    t.start()
+
+    if transport == 'socket-recv-into':
+        sock = common.connect_socket(('127.0.0.1', port))
+    else:
+        sock = common.connect_tool(port)
+    json_rpc = common.JsonRpc(sock, sock, False, False)
+    json_rpc.codec = codec
+    elapsed = consume(json_rpc, count)
+
+    t.join()
+    listener.close()
+    return elapsed
+
+
+def consume(json_rpc, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        json_rpc.pull_one_message()
+    return time.perf_counter() - start
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--count', type=int, default=20000,
+                           help='number of messages to send')
+    argparser.add_argument('--size', type=int, default=1024,
+                           help='approximate size of each message body')
+    argparser.add_argument('--transport',
+                           choices=['pipe', 'socket', 'socket-recv-into'],
+                           default='pipe',
+                           help=('socket reads through a socket makefile, '
+                                 'socket-recv-into with a SocketTransport'))
+    argparser.add_argument('--json-codec', choices=['auto', 'json', 'orjson',
+                                                    'ujson'],
+                           default='json', help='JSON codec to decode with')
+    args = argparser.parse_args()
+
+    data, body_size = make_frames(args.count, args.size)
+    codec = common.make_codec(args.json_codec)
+
+    if args.transport == 'pipe':
+        elapsed = bench_pipe(data, args.count, codec)
+    else:
+        elapsed = bench_socket(data, args.count, args.transport,
+                               codec)
+
+    print('{} messages of {} bytes over {} in {:.3f} s'.format(
+        args.count, body_size, args.transport, elapsed))
+    print('{:.1f} MB/s, {:.0f} messages/s'.format(
+        len(data) / elapsed / 1e6, args.count / elapsed))
+
+
+if __name__ == '__main__':
+    main()
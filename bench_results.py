@@ -0,0 +1,99 @@
+#
+# Memory and time benchmark of the compact result model (results.py)
+# against the plain dicts returned by the JSON codec, on a large references
+# reply and a large workspace/symbol reply.  'model' converts the dicts,
+# 'raw' is what JsonRpc does with results.raw_decoder.
+#
+# Run with: python3 bench_results.py [--locations N] [--symbols N] [--json-codec NAME]
+#
+
+import argparse
+import gc
+import time
+import tracemalloc
+
+import common
+import results
+import stub_server
+
+
+def measure(fn):
+    ''' Call FN, return its result, the memory it still holds and the peak
+    memory during the call (both in bytes).  '''
+
+    gc.collect()
+    tracemalloc.start()
+    result = fn()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, current, peak
+
+
+def timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def bench(name, method_name, data, codec, uri):
+    print('{} ({:.1f} MB of JSON):'.format(name, len(data) / 1e6))
+
+    def decode_dicts():
+        return codec.loads(data)['result']
+
+    def decode_model():
+        return results.decode(method_name, codec.loads(data)['result'])
+
+    raw_decoder = results.raw_decoder(method_name)
+
+    def decode_raw():
+        return raw_decoder(data, codec, 'utf-8')['result']
+
+    for label, decode in (('dicts', decode_dicts), ('model', decode_model),
+                          ('raw', decode_raw)):
+        # Tracing slows allocations down, time without it.
+        elapsed = timed(decode)
+        r, current, peak = measure(decode)
+        print('  {:5}  decode {:8.1f} ms  held {:8.1f} MB  peak {:8.1f} MB'
+              .format(label, elapsed * 1000, current / 1e6, peak / 1e6))
+
+        if label == 'dicts':
+            by_uri = timed(lambda: [item for item in r
+                                    if (item.get('location') or item)['uri']
+                                    == uri])
+        else:
+            by_uri = timed(lambda: r.filter_uri(uri))
+        walk = timed(lambda: [item for item in r])
+        print('         len {:8.3f} ms  filter by URI {:8.1f} ms  '
+              'walk all {:8.1f} ms'.format(timed(lambda: len(r)) * 1000,
+                                           by_uri * 1000, walk * 1000))
+        del r
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--locations', type=int, default=300000,
+                           help='number of locations in the references reply')
+    argparser.add_argument('--symbols', type=int, default=100000,
+                           help='number of symbols in the symbol reply')
+    argparser.add_argument('--json-codec', default='auto',
+                           choices=['auto'] + list(common.CODECS),
+                           help='JSON codec to decode with')
+    args = argparser.parse_args()
+
+    codec = common.make_codec(args.json_codec)
+    uri = 'file:///stub/src/file7.cpp'
+
+    def encode(result):
+        return codec.dumps({'jsonrpc': '2.0', 'id': 123, 'result': result})
+
+    print('codec: {}'.format(codec.name))
+    bench('references', 'textDocument/references',
+          encode(stub_server.make_locations(args.locations)), codec, uri)
+    bench('workspace/symbol', 'workspace/symbol',
+          encode(stub_server.make_symbols(args.symbols)), codec, uri)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,22 @@
 import subprocess
 import json
+import os
+import re
+import select
 import socket
+import sys
+import collections
+import heapq
+import itertools
+import threading
+import time
+import queue
+import atexit
+import traceback
+from concurrent.futures import Future
 
-from colorama import Fore, Back, Style
-from pygments import highlight
-from pygments.lexers import JsonLexer
-from pygments.formatters import TerminalFormatter
 
-
-def print_log(json_bytes, sender, log_pretty):
+def print_log(json_bytes, sender, log_pretty, truncate=None, color=True):
     assert type(json_bytes) == bytes
     assert sender == 'client' or sender == 'server'
 
@@ -17,17 +25,177 @@ def print_log(json_bytes, sender, log_pretty):
     if log_pretty:
         j = json.dumps(json.loads(j), indent=4)
 
+    if truncate is not None and len(j) > truncate:
+        j = '{}... [{} more characters]\n'.format(j[:truncate],
+                                                  len(j) - truncate)
+
     if sender == 'client':
         prefix = 'client --> server'
-        back = Back.GREEN
     else:
         prefix = 'server --> client'
-        back = Back.BLUE
+
+    if not color:
+        print('{}: {}'.format(prefix, j))
+        return
+
+    # Only needed when logging to a terminal, don't import them otherwise.
+    from colorama import Fore, Back, Style
+    from pygments import highlight
+    from pygments.lexers import JsonLexer
+    from pygments.formatters import TerminalFormatter
+
+    back = Back.GREEN if sender == 'client' else Back.BLUE
 
     j = highlight(j, JsonLexer(), TerminalFormatter())
     print('{}{}{}{}: {}'.format(back, Fore.BLACK, prefix, Style.RESET_ALL, j))
 
 
+class MessageLogger:
+    ''' Log the messages exchanged with the server, off the hot path.
+
+    log() only queues the raw message bytes, a background thread does the
+    rendering.  Messages are either written as JSON lines to LOG_FILE, or
+    printed to stdout: colorized (and pretty-printed if PRETTY) when stdout
+    is a terminal, plain otherwise.  When printing, messages longer than
+    TRUNCATE characters are truncated.
+
+    The time "t" of each line of LOG_FILE is a time.monotonic() value.  '''
+
+    def __init__(self, pretty=False, log_file=None, truncate=None):
+        self._pretty = pretty
+        self._truncate = truncate
+        self._file = open(log_file, 'wb') if log_file else None
+        self._color = self._file is None and sys.stdout.isatty()
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    @staticmethod
+    def from_args(args):
+        ''' Create a logger from the --log* command line options, return
+        None if logging is disabled.  '''
+
+        if not args.log and not args.log_file:
+            return None
+
+        return MessageLogger(args.log_pretty, args.log_file, args.log_truncate)
+
+    def log(self, json_bytes, sender):
+        self._queue.put((time.monotonic(), sender, json_bytes))
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            t, sender, json_bytes = item
+
+            if self._file is not None:
+                direction = b'c' if sender == 'client' else b's'
+                body = json_bytes.replace(b'\n', b' ').replace(b'\r', b' ')
+                self._file.write(b'{"t":%.6f,"dir":"%s","msg":%s}\n'
+                                 % (t, direction, body))
+            else:
+                print_log(json_bytes, sender, self._pretty, self._truncate,
+                          self._color)
+
+        if self._file is not None:
+            self._file.close()
+
+    def close(self):
+        ''' Write the queued messages and stop the writer thread.  '''
+
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+
+class StdlibJsonCodec:
+    ''' Encode/decode messages with the json module.  '''
+
+    name = 'json'
+    # Whether loads accepts a memoryview (see MessageFramer.next_body).
+    loads_memoryview = False
+
+    def dumps(self, obj):
+        return json.dumps(obj).encode()
+
+    def loads(self, data, charset='utf-8'):
+        # json.loads decodes UTF-8 bytes itself.
+        if charset != 'utf-8':
+            data = bytes(data).decode(charset)
+
+        return json.loads(data)
+
+
+class OrjsonCodec:
+    ''' Encode/decode messages with orjson, which works on bytes directly.
+    '''
+
+    name = 'orjson'
+    loads_memoryview = True
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def dumps(self, obj):
+        return self._orjson.dumps(obj)
+
+    def loads(self, data, charset='utf-8'):
+        if charset != 'utf-8':
+            data = bytes(data).decode(charset)
+
+        return self._orjson.loads(data)
+
+
+class UjsonCodec:
+    ''' Encode/decode messages with ujson.  '''
+
+    name = 'ujson'
+    loads_memoryview = False
+
+    def __init__(self):
+        import ujson
+        self._ujson = ujson
+
+    def dumps(self, obj):
+        return self._ujson.dumps(obj, ensure_ascii=False).encode()
+
+    def loads(self, data, charset='utf-8'):
+        if charset != 'utf-8':
+            data = bytes(data).decode(charset)
+
+        return self._ujson.loads(data)
+
+
+# The id of a reply, found without decoding it (see JsonRpc._decode).
+RAW_ID_RE = re.compile(rb'"id"\s*:\s*(-?\d+|"[^"\\]*")')
+
+
+CODECS = {
+    'orjson': OrjsonCodec,
+    'ujson': UjsonCodec,
+    'json': StdlibJsonCodec,
+}
+
+
+def make_codec(name='auto'):
+    ''' Return the JSON codec called NAME.  With 'auto', return the fastest
+    one installed (orjson, then ujson, then the json module).  '''
+
+    if name != 'auto':
+        return CODECS[name]()
+
+    for codec_class in CODECS.values():
+        try:
+            return codec_class()
+        except ImportError:
+            pass
+
+
 def start_tool(langserv):
     ''' Start the language server, return a Popen object. '''
 
@@ -42,22 +210,372 @@ def connect_tool(port):
     return s.makefile(mode='rwb')
 
 
+def socket_address(server):
+    ''' Return the address of the server to connect to if SERVER is :PORT
+    (a TCP port on localhost) or unix:PATH (a Unix domain socket), None if
+    it is a command line.  '''
+
+    m = re.match(r':(\d{1,5})$', server)
+    if m:
+        return ('127.0.0.1', int(m.group(1)))
+
+    if server.startswith('unix:'):
+        return server[len('unix:'):]
+
+    return None
+
+
+def connect_socket(address):
+    ''' Connect to the server at ADDRESS (see socket_address), return a
+    SocketTransport.  '''
+
+    if isinstance(address, str):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+    else:
+        sock = socket.create_connection(address)
+        # Messages are sent in one go, don't delay them.
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    return SocketTransport(sock)
+
+
+class SocketTransport:
+    ''' Socket connection to a server, to give to JsonRpc as both its
+    input and output.
+
+    Unlike a socket makefile, received data goes straight into the framer's
+    buffer (see MessageFramer.recv_into), and the header and body of a
+    message are sent with a single sendmsg, without joining them.  '''
+
+    # Maximum number of buffers in one sendmsg.
+    IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 16
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def recv_into(self, buf):
+        return self.sock.recv_into(buf)
+
+    def send_buffers(self, buffers):
+        ''' Send all of BUFFERS, in order.  '''
+
+        views = [memoryview(b) for b in buffers if len(b) > 0]
+        i = 0
+
+        while i < len(views):
+            sent = self.sock.sendmsg(views[i:i + self.IOV_MAX])
+
+            # Skip what was sent, sendmsg may stop in the middle of a buffer.
+            while sent > 0:
+                if sent >= len(views[i]):
+                    sent -= len(views[i])
+                    i += 1
+                else:
+                    views[i] = views[i][sent:]
+                    sent = 0
+
+    def close(self):
+        self.sock.close()
+
+
+def read_chunk(inp, size):
+    ''' Read whatever is available (at most SIZE bytes) from INP.
+
+    Buffered streams (Popen pipes, socket makefiles) provide read1, which
+    returns as soon as some data is available instead of waiting for SIZE
+    bytes.  '''
+
+    if hasattr(inp, 'read1'):
+        return inp.read1(size)
+
+    return inp.read(size)
+
+
+class MessageFramer:
+    ''' Incremental decoder for the Content-Length framing used by LSP/DAP.
+
+    Raw chunks read from the server are fed with feed(), complete message
+    bodies are retrieved with next_body().  A single chunk can contain any
+    number of messages (or a fraction of one).  '''
+
+    READ_SIZE = 64 * 1024
+
+    def __init__(self):
+        self._buf = bytearray()
+        # Start of the unconsumed data in _buf.
+        self._pos = 0
+        # End of the received data in _buf.  recv_into leaves free space
+        # after it.
+        self._end = 0
+        # Body length of the message being read, once its header is parsed.
+        self._content_length = None
+        self._charset = 'utf-8'
+        self.last_charset = 'utf-8'
+        # Time at which the first byte of the message being read arrived,
+        # and the same for the last message returned by next_body.
+        self._first_byte_time = None
+        self._last_feed_time = None
+        self.last_first_byte_time = None
+
+    def _compact(self):
+        # Drop the consumed prefix before growing the buffer, so it doesn't
+        # grow without bound during a long session.
+        if self._pos > 0:
+            del self._buf[:self._pos]
+            self._end -= self._pos
+            self._pos = 0
+
+    def _received(self, n):
+        # Called once N bytes have arrived, to time them.
+        now = time.monotonic()
+        if self._end == 0:
+            self._first_byte_time = now
+
+        self._end += n
+        self._last_feed_time = now
+
+    def feed(self, data):
+        self._compact()
+        self._buf[self._end:self._end + len(data)] = data
+        self._received(len(data))
+
+    def recv_into(self, sock):
+        ''' Receive data from SOCK (anything with a recv_into method)
+        directly into the buffer.  Return the number of bytes received, 0
+        at the end of the stream.
+
+        The buffer grows to fit the whole message being read, so large
+        messages are received without intermediate copies.  '''
+
+        self._compact()
+
+        want = self.READ_SIZE
+        if self._content_length is not None:
+            want = max(want, self._content_length - self._end)
+
+        free = len(self._buf) - self._end
+        if free < want:
+            self._buf.extend(bytes(want - free))
+
+        with memoryview(self._buf) as view:
+            n = sock.recv_into(view[self._end:])
+
+        # Timed once the data is there, not when we started waiting for it.
+        if n > 0:
+            self._received(n)
+        return n
+
+    def _parse_header(self):
+        end = self._buf.find(b'\r\n\r\n', self._pos, self._end)
+        if end < 0:
+            return False
+
+        content_length = -1
+        charset = 'utf-8'
+
+        for h in bytes(self._buf[self._pos:end]).split(b'\r\n'):
+            name, _, value = h.partition(b':')
+            name = name.strip().lower()
+            value = value.strip()
+
+            if name == b'content-length':
+                content_length = int(value)
+            elif name == b'content-type':
+                for param in value.split(b';')[1:]:
+                    key, _, val = param.partition(b'=')
+                    if key.strip().lower() == b'charset':
+                        charset = val.strip().decode('ascii')
+
+        assert content_length > 0
+
+        # clangd used to send "utf8", which Python understands, but be
+        # lenient with other spellings of the same thing.
+        if charset.lower().replace('-', '') == 'utf8':
+            charset = 'utf-8'
+
+        self._pos = end + 4
+        self._content_length = content_length
+        self._charset = charset
+        return True
+
+    def has_message(self):
+        ''' Return whether a complete message is buffered.  '''
+
+        if self._content_length is None and not self._parse_header():
+            return False
+
+        return self._end >= self._pos + self._content_length
+
+    def next_body(self, copy=True):
+        ''' Return the next complete message body as bytes, or None if more
+        data is needed.
+
+        If COPY is false, return a memoryview of the buffer instead.  It must
+        be released before the next feed or recv_into.  '''
+
+        if self._content_length is None and not self._parse_header():
+            return None
+
+        end = self._pos + self._content_length
+        if self._end < end:
+            return None
+
+        if copy:
+            with memoryview(self._buf) as view:
+                body = bytes(view[self._pos:end])
+        else:
+            body = memoryview(self._buf)[self._pos:end]
+
+        self._pos = end
+        self._content_length = None
+        self.last_charset = self._charset
+        self.last_first_byte_time = self._first_byte_time
+
+        # If the next message has already started, its first byte came with
+        # the last chunk.
+        if self._pos < self._end:
+            self._first_byte_time = self._last_feed_time
+        else:
+            self._first_byte_time = None
+
+        return body
+
+
+def request_window(reqs, send, wait_for, window=None):
+    ''' Sliding window behind the request_many methods: SEND(batch) sends
+    the requests of the list BATCH and returns their pendings, WAIT_FOR
+    waits for one of them.  Keep at most WINDOW requests of REQS awaiting a
+    reply (no limit if None), return their results in order.  '''
+
+    reqs = list(reqs)
+    if window is None:
+        window = max(len(reqs), 1)
+
+    assert window > 0
+
+    pendings = send(reqs[:window])
+
+    results = []
+    for i in range(len(reqs)):
+        results.append(wait_for(pendings[i]))
+
+        if len(pendings) < len(reqs):
+            pendings += send(reqs[len(pendings):len(pendings) + 1])
+
+    return results
+
+
+class RequestTimeout(TimeoutError):
+    ''' Raised when waiting for the reply to a request that went past its
+    deadline.  The request has been cancelled.  '''
+
+    def __init__(self, method_name, the_id, timeout):
+        super().__init__('{} request (id {}) timed out after {} s'.format(
+            method_name, the_id, timeout))
+        self.method_name = method_name
+        self.id = the_id
+        self.timeout = timeout
+
+
+class ResponseError(Exception):
+    ''' Raised when waiting for the reply to a request that the server
+    answered with an error.  '''
+
+    def __init__(self, the_id, error):
+        super().__init__('request (id {}) failed: {} ({})'.format(
+            the_id, error.get('message'), error.get('code')))
+        self.id = the_id
+        self.code = error.get('code')
+        self.error = error
+
+
+class DeadlineScheduler:
+    ''' Run callbacks when their deadline passes.
+
+    It is either driven by its user (time_until_next and run_expired), or
+    runs in a thread of its own (start_thread).  '''
+
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def add(self, deadline, callback):
+        with self._cond:
+            heapq.heappush(self._heap, (deadline, next(self._seq), callback))
+            self._cond.notify()
+
+    def time_until_next(self):
+        ''' Return the number of seconds until the next deadline, None if
+        there is none.  '''
+
+        with self._cond:
+            if not self._heap:
+                return None
+
+            return max(self._heap[0][0] - time.monotonic(), 0)
+
+    def run_expired(self):
+        now = time.monotonic()
+        due = []
+
+        with self._cond:
+            while self._heap and self._heap[0][0] <= now:
+                due.append(heapq.heappop(self._heap)[2])
+
+        for callback in due:
+            callback()
+
+    def start_thread(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while True:
+                    timeout = None
+                    if self._heap:
+                        timeout = self._heap[0][0] - time.monotonic()
+                        if timeout <= 0:
+                            break
+
+                    self._cond.wait(timeout)
+
+            self.run_expired()
+
+
 class JsonRpc:
     class JsonRpcPendingId:
         def __init__(self, the_id):
             self._id = the_id
 
+        def key(self):
+            return ('id', str(self._id))
+
         def matches(self, json_data):
             return ('id' in json_data
                     and str(json_data['id']) == str(self._id))
 
         def extract(self, json_data):
+            if 'error' in json_data:
+                raise ResponseError(self._id, json_data['error'])
+
             return json_data['result']
 
     class JsonRpcPendingMethod:
         def __init__(self, method_name):
             self._method_name = method_name
 
+        def key(self):
+            return ('method', self._method_name)
+
         def matches(self, json_data):
             return ('method' in json_data
                     and json_data['method'] == self._method_name)
@@ -65,12 +583,131 @@ class JsonRpc:
         def extract(self, json_data):
             return json_data['params']
 
-    def __init__(self, output, inp, log, log_pretty):
+    def __init__(self, output, inp, log, log_pretty, reader_thread=False,
+                 logger=None):
         self._output = output
-        self._next_id = 123
+        self._ids = itertools.count(123)
+        self._write_lock = threading.Lock()
         self._input = inp
-        self._log = log
-        self._log_pretty = log_pretty
+        if logger is None and log:
+            logger = MessageLogger(log_pretty)
+        self._logger = logger
+        self._framer = MessageFramer()
+        # Used to encode and decode messages, see make_codec.
+        self.codec = StdlibJsonCodec()
+        # Messages received but not claimed yet, keyed by message_key().
+        # Responses end up in a queue of their own (keyed by id),
+        # notifications are queued by method.
+        self._inbox = {}
+        # Number of unclaimed messages kept per method (the oldest are
+        # dropped), None for no limit.  Replies are always kept.
+        self.max_queued = 1000
+        # With a reader thread: (pending, Future) pairs waiting for a
+        # message, keyed like _inbox.
+        self._waiters = collections.defaultdict(collections.deque)
+        self._lock = threading.Lock()
+        # Notified (with _lock held) each time a message is dispatched.
+        self._arrived = threading.Condition(self._lock)
+        self._arrival_count = 0
+        # Handlers called for each message, keyed like _inbox.
+        self._handlers = {}
+        self._reader = None
+        self._closed = None
+        self._arrival_listeners = []
+        # Capabilities returned by the server in reply to initialize.
+        self.server_capabilities = None
+        # Optional stats.LatencyStats, recording the timing of requests.
+        self.stats = None
+        # Optional session_trace.TraceRecorder, recording all messages.
+        self.recorder = None
+        # Optional resource_sampler.ResourceSampler, sampling the server's
+        # resource usage.
+        self.resource_sampler = None
+        # Timeout (in seconds) of requests sent without an explicit one.
+        self.default_timeout = None
+        self._scheduler = DeadlineScheduler()
+        # Requests with a deadline, not replied to yet:
+        # key -> (id, method, timeout).
+        self._deadlines = {}
+        # Expired requests nobody waited for yet: key -> RequestTimeout.
+        self._expired = {}
+        # Cancelled requests, whose (late) reply will be dropped.
+        self._cancelled = set()
+        self._partial_tokens = itertools.count()
+        # Method -> decoder used for the replies to requests of that method
+        # sent without an explicit one, see request.
+        self.result_decoders = {}
+        # Decoders of the replies not received yet, keyed like _inbox.
+        self._decoders = {}
+        # With a reader thread: frames of our replies to the server's
+        # requests, sent by the reply thread (see send_reply).
+        self._replies = None
+
+        if reader_thread:
+            self._replies = queue.SimpleQueue()
+            threading.Thread(target=self._reply_loop, daemon=True).start()
+            self._reader = threading.Thread(target=self._read_loop,
+                                            daemon=True)
+            self._reader.start()
+
+    def _read_loop(self):
+        ''' Body of the reader thread: drain the server's output as fast as
+        possible, so it never blocks on a full pipe.  '''
+
+        try:
+            while True:
+                self.dispatch(self.pull_one_message())
+                for listener in self._arrival_listeners:
+                    listener()
+        except Exception as e:
+            with self._lock:
+                self._closed = e
+                waiters = [fut for queue in self._waiters.values()
+                           for _, fut in queue]
+                self._waiters.clear()
+                self._arrived.notify_all()
+
+            for fut in waiters:
+                fut.set_exception(e)
+
+            for listener in self._arrival_listeners:
+                listener()
+
+    def add_arrival_listener(self, listener):
+        ''' With a reader thread, call LISTENER() (in the reader thread)
+        each time a message was dispatched, and when the reader thread
+        ends.  Used to wait on several JsonRpc at once.  '''
+
+        self._arrival_listeners = self._arrival_listeners + [listener]
+
+    @property
+    def closed(self):
+        ''' The exception that ended the reader thread, None while it
+        runs.  '''
+
+        return self._closed
+
+    def _reply_loop(self):
+        try:
+            while True:
+                self._send(self._replies.get())
+        except OSError:
+            # The server is gone.
+            pass
+
+    def send_reply(self, obj):
+        ''' Send OBJ, a reply to a request sent by the server.
+
+        Replies are sent as requests are received, by the reader thread if
+        there is one.  It must never block on a write (another thread may be
+        in the middle of a large one), or the server could block writing to
+        us, so they are left to the reply thread.  '''
+
+        frame = self._frame(obj)
+        if self._replies is None:
+            self._send(frame)
+        else:
+            self._replies.put(frame)
 
     def encodeRequest(self, the_id, method_name, params):
         obj = {}
@@ -83,25 +720,273 @@ class JsonRpc:
     def pending_id(self, the_id):
         return JsonRpc.JsonRpcPendingId(the_id)
 
-    def request(self, req):
+    def _frame(self, obj):
+        ''' Encode OBJ, return the list of buffers to send.  '''
+
+        b = self.codec.dumps(obj)
+        header = 'Content-Length: {}\r\n\r\n'.format(len(b)).encode()
+
+        if self._logger is not None:
+            self._logger.log(b, 'client')
+
+        if self.recorder is not None:
+            self.recorder.record(b, 'client')
+
+        return [header, b]
+
+    def _send(self, buffers):
+        # Cancellations may be sent from the scheduler thread.
+        with self._write_lock:
+            if isinstance(self._output, SocketTransport):
+                self._output.send_buffers(buffers)
+                return
+
+            for b in buffers:
+                self._output.write(b)
+            self._output.flush()
+
+    def _prepare_request(self, req, timeout=None, decoder=None):
         method_name = req.get_method_name()
         params = req.get_params()
 
-        the_id = self._next_id
-        self._next_id += 1
+        the_id = next(self._ids)
         obj = self.encodeRequest(the_id, method_name, params)
+        frame = self._frame(obj)
 
-        b = json.dumps(obj).encode()
-        header = 'Content-Length: {}\r\n\r\n'.format(len(b)).encode()
+        if self.stats is not None:
+            self.stats.on_send(str(the_id), method_name,
+                               sum(len(b) for b in frame))
+
+        pending = self.pending_id(the_id)
+
+        if decoder is None:
+            decoder = self.result_decoders.get(method_name)
+        if decoder is not None:
+            with self._lock:
+                self._decoders[pending.key()] = decoder
+
+        if timeout is None:
+            timeout = self.default_timeout
+
+        if timeout is not None:
+            self._arm(pending.key(), the_id, method_name, timeout)
+
+        return pending, frame
+
+    def _arm(self, key, the_id, method_name, timeout):
+        with self._lock:
+            self._deadlines[key] = (the_id, method_name, timeout)
+
+        self._scheduler.add(time.monotonic() + timeout,
+                            lambda: self._expire(key))
+
+        if self._reader is not None:
+            self._scheduler.start_thread()
+
+    def _expire(self, key):
+        ''' Called when the deadline of the request with KEY passes: cancel
+        it and make whoever waits for it raise RequestTimeout.  '''
+
+        with self._lock:
+            entry = self._deadlines.pop(key, None)
+            if entry is None:
+                # Already replied to.
+                return
+
+            the_id, method_name, timeout = entry
+            error = RequestTimeout(method_name, the_id, timeout)
+            self._cancelled.add(key)
+
+            waiters = self._waiters.pop(key, ())
+            if not waiters:
+                self._expired[key] = error
+
+        if self.stats is not None:
+            self.stats.on_cancel(str(the_id))
+
+        self.send_cancel(the_id)
+
+        for _, fut in waiters:
+            fut.set_exception(error)
+
+    def send_cancel(self, the_id):
+        self._send(self._frame({
+            'jsonrpc': '2.0',
+            'method': '$/cancelRequest',
+            'params': {'id': the_id},
+        }))
+
+    def _expect(self, pending):
+        ''' With a reader thread, return a Future resolved with the result
+        of PENDING, otherwise return PENDING itself.  '''
+
+        if self._reader is None:
+            return pending
+
+        fut = Future()
+        fut.sent_time = time.monotonic()
+        # Like pending, the Future can tell which reply it's waiting for.
+        fut.key = pending.key
+
+        with self._lock:
+            json_data = self._take(pending.key())
+            if json_data is None:
+                if pending.key() in self._expired:
+                    fut.set_exception(self._expired.pop(pending.key()))
+                elif self._closed is not None:
+                    fut.set_exception(self._closed)
+                else:
+                    self._waiters[pending.key()].append((pending, fut))
+                return fut
+
+        fut.reply_time = fut.sent_time
+        try:
+            fut.set_result(pending.extract(json_data))
+        except Exception as e:
+            fut.set_exception(e)
+        return fut
+
+    def request(self, req, timeout=None, decoder=None):
+        ''' Send REQ.  Return the object to pass to wait_for or, with a
+        reader thread, a concurrent.futures.Future.
+
+        If the reply doesn't arrive within TIMEOUT seconds (default:
+        default_timeout), the request is cancelled and waiting for it raises
+        RequestTimeout.
+
+        DECODER (default: result_decoders[method]) decodes the raw reply
+        instead of the codec: DECODER(body, codec, charset) returns the
+        message, for example with the result in a compact form (see
+        results.raw_decoder).  '''
+
+        pending, frame = self._prepare_request(req, timeout, decoder)
+        pending = self._expect(pending)
+        self._send(frame)
+
+        return pending
+
+    def request_many(self, reqs, window=None, timeout=None):
+        ''' Send the requests in REQS back-to-back and return their results,
+        in the same order as REQS.
+
+        At most WINDOW requests are awaiting a reply at any given time (no
+        limit if None).  TIMEOUT applies to each request, as for request().
+        '''
+
+        def send(batch):
+            pendings = []
+            frames = []
+            for req in batch:
+                pending, frame = self._prepare_request(req, timeout)
+                pendings.append(self._expect(pending))
+                frames += frame
+
+            if frames:
+                self._send(frames)
+
+            return pendings
+
+        return request_window(reqs, send, self.wait_for, window)
+
+    def stream(self, req, timeout=None):
+        ''' Send REQ (which must have a partial_result_token attribute, like
+        FindReferences and WorkspaceSymbol) and yield its result in chunks,
+        as the server sends them in $/progress partial result
+        notifications, then the final reply if it's not empty.  If the
+        server doesn't support partial results, the only chunk is the whole
+        result.
+
+        If the generator is closed before the end, the request is
+        cancelled.  '''
+
+        token = 'partial-{}'.format(next(self._partial_tokens))
+        req.partial_result_token = token
+        # (is_final, value) pairs, in the order the messages arrived.
+        chunks = queue.Queue()
+
+        def on_progress(json_data):
+            params = json_data.get('params') or {}
+            if params.get('token') != token:
+                return False
+
+            chunks.put((False, params.get('value')))
+            return True
+
+        progress_key = ('method', '$/progress')
+        self.add_handler(progress_key, on_progress)
+
+        pending, frame = self._prepare_request(req, timeout)
+        key = pending.key()
+        waiting = self._expect(pending)
+        if isinstance(waiting, Future):
+            waiting.add_done_callback(lambda fut: chunks.put((True, fut)))
+        self._send(frame)
+
+        done = False
+        try:
+            while True:
+                if isinstance(waiting, Future):
+                    is_final, value = chunks.get()
+                else:
+                    is_final, value = self._next_chunk(pending, chunks)
+
+                if is_final:
+                    # Received, even if it's an error: nothing to cancel.
+                    done = True
+                    if isinstance(waiting, Future):
+                        value = value.result()
+                    else:
+                        value = pending.extract(value)
+                if value:
+                    yield value
+                if done:
+                    return
+        finally:
+            self.remove_handler(progress_key, on_progress)
+            if not done:
+                self._abandon(key, pending._id)
+
+    def _next_chunk(self, pending, chunks):
+        ''' Without a reader thread, wait for the next partial result
+        (False, value) or the reply (True, message) of PENDING.  '''
+
+        key = pending.key()
+
+        while True:
+            try:
+                return chunks.get_nowait()
+            except queue.Empty:
+                pass
+
+            json_data = self._take(key)
+            if json_data is not None:
+                return True, json_data
+
+            self._scheduler.run_expired()
+            if key in self._expired:
+                raise self._expired.pop(key)
+
+            self.pump(self._scheduler.time_until_next())
+
+    def _abandon(self, key, the_id):
+        ''' Cancel the request THE_ID (with KEY) nobody wants the reply to
+        anymore, unless it was already received.  '''
+
+        with self._lock:
+            if self._take(key) is not None or key in self._cancelled:
+                return
+
+            self._deadlines.pop(key, None)
+            self._expired.pop(key, None)
+            self._waiters.pop(key, None)
+            self._cancelled.add(key)
 
-        self._output.write(header)
-        if self._log:
-            print_log(b, 'client', self._log_pretty)
+        self.send_cancel(the_id)
 
-        self._output.write(b)
-        self._output.flush()
+    def gather(self, pendings):
+        ''' Wait for all PENDINGS and return their results, in order.  '''
 
-        return self.pending_id(the_id)
+        return [self.wait_for(p) for p in pendings]
 
     def notify(self, notif):
         method_name = notif.get_method_name()
@@ -113,49 +998,342 @@ class JsonRpc:
         obj['method'] = method_name
         obj['params'] = params
 
-        b = json.dumps(obj).encode()
-        header = 'Content-Length: {}\r\n\r\n'.format(len(b)).encode()
+        self._send(self._frame(obj))
+
+    def _fill(self):
+        ''' Read more data from the server into the framer.  '''
+
+        if isinstance(self._input, SocketTransport):
+            if self._framer.recv_into(self._input) == 0:
+                raise EOFError('connection to the server was closed')
+            return
 
-        self._output.write(header)
-        if self._log:
-            print_log(b, 'client', self._log_pretty)
+        chunk = read_chunk(self._input, self._framer.READ_SIZE)
+        if not chunk:
+            raise EOFError('connection to the server was closed')
 
-        self._output.write(b)
-        self._output.flush()
+        self._framer.feed(chunk)
 
     def pull_one_message(self):
-        buf = b""
+        # Decode the body in place if nobody keeps it around.
+        copy = (not getattr(self.codec, 'loads_memoryview', False)
+                or self._logger is not None or self.recorder is not None)
 
-        while True:
-            buf += self._input.read(1)
+        body = self._framer.next_body(copy)
+
+        while body is None:
+            self._fill()
+            body = self._framer.next_body(copy)
+
+        if self._logger is not None:
+            self._logger.log(body, 'server')
+
+        if self.recorder is not None:
+            self.recorder.record(body, 'server')
+
+        try:
+            json_data = self._decode(body, self._framer.last_charset)
+            self._record_reply(json_data, body)
+        finally:
+            if not copy:
+                body.release()
+
+        return json_data
+
+    def _decode(self, body, charset):
+        ''' Decode BODY, with the decoder of the request it replies to if
+        it has one.  '''
+
+        if not self._decoders:
+            return self.codec.loads(body, charset)
+
+        # Only replies have a decoder, guess which one this is without
+        # decoding it.  Guessing wrong is harmless: decoders return
+        # whatever message they're given.
+        decoder = None
+        m = RAW_ID_RE.search(body)
+        if m is not None:
+            key = ('id', m.group(1).strip(b'"').decode())
+            decoder = self._decoders.get(key)
+
+        if decoder is None:
+            json_data = self.codec.loads(body, charset)
+        else:
+            json_data = decoder(body, self.codec, charset)
+
+        key = self.message_key(json_data)
+        if key is not None and key[0] == 'id':
+            with self._lock:
+                self._decoders.pop(key, None)
+
+        return json_data
+
+    def _record_reply(self, json_data, body):
+        if self.stats is None:
+            return
+
+        key = self.message_key(json_data)
+        if key is not None and key[0] == 'id':
+            self.stats.on_reply(key[1], self._framer.last_first_byte_time,
+                                len(body))
+
+    def message_key(self, json_data):
+        ''' Return the key under which a received message is dispatched.
+
+        It must match the key() of the pending object waiting for it.  '''
+
+        if 'method' in json_data:
+            return ('method', json_data['method'])
+
+        if 'id' in json_data:
+            return ('id', str(json_data['id']))
+
+        return None
+
+    def add_handler(self, key, handler):
+        ''' Call HANDLER(json_data) for each received message whose
+        message_key() is KEY, as soon as it is received (in the reader
+        thread, if there is one).  If HANDLER returns True, the message is
+        consumed: nobody can wait_for it.  '''
+
+        # Copied on write, as the reader thread may be going through them.
+        self._handlers[key] = self._handlers.get(key, []) + [handler]
+
+    def remove_handler(self, key, handler):
+        handlers = [h for h in self._handlers.get(key, ()) if h != handler]
+        if handlers:
+            self._handlers[key] = handlers
+        else:
+            self._handlers.pop(key, None)
+
+    def on_notification(self, method_name, handler):
+        self.add_handler(('method', method_name), handler)
+
+    def respond(self, the_id, result):
+        ''' Send RESULT as the reply to the request THE_ID sent by the
+        server.  '''
+
+        self.send_reply({
+            'jsonrpc': '2.0',
+            'id': the_id,
+            'result': result,
+        })
+
+    def respond_error(self, the_id, code, message):
+        ''' Reply to the request THE_ID sent by the server with an error.  '''
+
+        self.send_reply({
+            'jsonrpc': '2.0',
+            'id': the_id,
+            'error': {'code': code, 'message': message},
+        })
+
+    def on_request(self, method_name, handler):
+        ''' Answer the METHOD_NAME requests sent by the server with the
+        value returned by HANDLER(params), as soon as they are received, or
+        with an error if it raises.  '''
+
+        def answer(json_data):
+            try:
+                result = handler(json_data.get('params'))
+            except Exception as e:
+                # Internal error.
+                self.respond_error(json_data['id'], -32603, str(e))
+            else:
+                self.respond(json_data['id'], result)
+            return True
+
+        self.add_handler(('method', method_name), answer)
+
+    def _run_handlers(self, key, json_data):
+        consumed = False
+        for handler in self._handlers.get(key, ()):
+            try:
+                if handler(json_data):
+                    consumed = True
+            except Exception:
+                # A broken handler must not stop the dispatching of the
+                # next messages (or kill the reader thread).
+                print('warning: {} handler failed:'.format(key[1]),
+                      file=sys.stderr)
+                traceback.print_exc()
+
+        return consumed
+
+    def dispatch(self, json_data):
+        key = self.message_key(json_data)
+        if key is None:
+            return
 
-            if buf.endswith(b'\r\n\r\n'):
-                content_length = -1
+        consumed = self._run_handlers(key, json_data)
 
-                headers = buf.split(b'\r\n')
-                for h in headers:
-                    if h.startswith(b'Content-Length: '):
-                        content_length = int(h[len(b'Content-Length: '):])
+        with self._lock:
+            self._arrival_count += 1
+            self._arrived.notify_all()
 
-                assert content_length > 0
+            if self._deadlines:
+                self._deadlines.pop(key, None)
 
-                buf = self._input.read(content_length)
+            if key in self._cancelled:
+                # Reply to a request that timed out, nobody wants it.
+                self._cancelled.discard(key)
+                return
 
-                assert len(buf) == content_length
+            if consumed:
+                return
 
-                if self._log:
-                    print_log(buf, 'server', self._log_pretty)
+            waiters = self._waiters.get(key)
+            if not waiters:
+                self._enqueue(key, json_data)
+                return
 
-                json_data = json.loads(buf.decode())
+            pending, fut = waiters.popleft()
+            if not waiters:
+                del self._waiters[key]
 
-                return json_data
+        fut.reply_time = time.monotonic()
+        try:
+            fut.set_result(pending.extract(json_data))
+        except Exception as e:
+            fut.set_exception(e)
+
+    def pump(self, timeout=None):
+        ''' Wait until a message is received and dispatched, for at most
+        TIMEOUT seconds (forever if None).  Return whether a message was
+        received.
+
+        Without a reader thread, this is also where request deadlines
+        fire: the wait stops at the next one.  '''
+
+        if self._reader is not None:
+            with self._lock:
+                count = self._arrival_count
+                if self._closed is not None:
+                    raise self._closed
+
+                return self._arrived.wait_for(
+                    lambda: (self._arrival_count != count
+                             or self._closed is not None), timeout)
+
+        self._scheduler.run_expired()
+        until_deadline = self._scheduler.time_until_next()
+        if until_deadline is not None and (timeout is None
+                                           or until_deadline < timeout):
+            timeout = until_deadline
+
+        if timeout is not None and not self._framer.has_message():
+            ready, _, _ = select.select([self._input], [], [], timeout)
+            if not ready:
+                self._scheduler.run_expired()
+                return False
+
+        self.dispatch(self.pull_one_message())
+        return True
+
+    def wait_until(self, predicate, timeout=None):
+        ''' Dispatch messages until PREDICATE() is true, for at most TIMEOUT
+        seconds (forever if None).  Return whether it is.
+
+        With a reader thread, PREDICATE is called with the lock the reader
+        thread takes to signal each message, so a message dispatched right
+        after PREDICATE was false still wakes us up.  It may look at the
+        received messages (_take) but must not take that lock or wait for
+        messages itself.  It is not called again once it returned true.  '''
+
+        if self._reader is not None:
+            met = False
+
+            def ready():
+                nonlocal met
+                met = predicate()
+                return met or self._closed is not None
+
+            with self._lock:
+                self._arrived.wait_for(ready, timeout)
+                if not met and self._closed is not None:
+                    raise self._closed
+                return met
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while not predicate():
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+
+            self.pump(remaining)
+
+        return True
+
+    def _enqueue(self, key, json_data):
+        queue = self._inbox.get(key)
+        if queue is None:
+            maxlen = None if key[0] == 'id' else self.max_queued
+            queue = self._inbox[key] = collections.deque(maxlen=maxlen)
+
+        queue.append(json_data)
+
+    def _take(self, key):
+        queue = self._inbox.get(key)
+        if not queue:
+            return None
+
+        json_data = queue.popleft()
+        if not queue:
+            del self._inbox[key]
+
+        return json_data
+
+    def take(self, pending):
+        ''' Return the payload of the message PENDING is waiting for if it
+        was already received, None otherwise.  Doesn't wait.  '''
+
+        with self._lock:
+            json_data = self._take(pending.key())
+
+        if json_data is None:
+            return None
+
+        return pending.extract(json_data)
+
+    def take_notifications(self, method_name):
+        ''' Return (and forget) all the already received notifications for
+        METHOD_NAME, without waiting for more.  '''
+
+        with self._lock:
+            queue = self._inbox.pop(('method', method_name), ())
+
+        return [JsonRpc.JsonRpcPendingMethod(method_name).extract(json_data)
+                for json_data in queue]
 
     def wait_for(self, pending):
+        ''' Wait for the message PENDING is waiting for and return its
+        payload.  PENDING may also be a Future returned by request().
+
+        Messages received in the mean time are not lost: they are kept until
+        someone waits for them.  '''
+
+        if isinstance(pending, Future):
+            return pending.result()
+
+        if self._reader is not None:
+            return self._expect(pending).result()
+
+        key = pending.key()
+
         while True:
-            json_data = self.pull_one_message()
-            if pending.matches(json_data):
+            json_data = self._take(key)
+            if json_data is not None:
                 return pending.extract(json_data)
 
+            self._scheduler.run_expired()
+            if key in self._expired:
+                raise self._expired.pop(key)
+
+            self.pump(self._scheduler.time_until_next())
+
 
 class Base:
 
@@ -1,6 +1,11 @@
 import common
+import async_common
 import argparse
+import asyncio
 import os
+import session_trace
+import subprocess
+import time
 from common import Base
 
 
@@ -8,6 +13,9 @@ class DebugAdapterPendingId:
     def __init__(self, the_id):
         self._id = the_id
 
+    def key(self):
+        return ('id', str(self._id))
+
     def matches(self, json_data):
         return ('request_seq' in json_data and
                 json_data['request_seq'] == self._id)
@@ -19,7 +27,52 @@ class DebugAdapterPendingId:
         return json_data['body']
 
 
+class DebugAdapterPendingEvent:
+    def __init__(self, event_name):
+        self._event_name = event_name
+
+    def key(self):
+        return ('event', self._event_name)
+
+    def matches(self, json_data):
+        return (json_data.get('type') == 'event'
+                and json_data.get('event') == self._event_name)
+
+    def extract(self, json_data):
+        return json_data.get('body', {})
+
+
+def run_in_terminal(arguments):
+    ''' Default handler of the runInTerminal reverse request.  We have no
+    terminal, so run the command in the background, its output going to
+    ours.  '''
+
+    env = dict(os.environ)
+    for name, value in (arguments.get('env') or {}).items():
+        # null means "remove this variable".
+        if value is None:
+            env.pop(name, None)
+        else:
+            env[name] = value
+
+    proc = subprocess.Popen(arguments['args'],
+                            cwd=arguments.get('cwd') or None, env=env)
+    return {'processId': proc.pid}
+
+
 class DebugAdapterTransport(common.JsonRpc):
+    ''' JSON-RPC flavor of the Debug Adapter Protocol.
+
+    Events are queued by name until someone waits for them (wait_for_event)
+    or takes them (take_events); use on_event to handle them as they
+    arrive instead.  Reverse requests sent by the adapter are answered by
+    the handlers registered with on_request (runInTerminal has a default
+    one), or with an error if there is none.  '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.on_request('runInTerminal', run_in_terminal)
+
     def encodeRequest(self, this_id, method_name, params):
         obj = {}
 
@@ -33,6 +86,150 @@ class DebugAdapterTransport(common.JsonRpc):
     def pending_id(self, the_id):
         return DebugAdapterPendingId(the_id)
 
+    def send_cancel(self, the_id):
+        pending, frame = self._prepare_request(Cancel(the_id))
+        # Nobody waits for the reply to the cancel request, and it doesn't
+        # get a deadline of its own.
+        with self._lock:
+            self._cancelled.add(pending.key())
+            self._deadlines.pop(pending.key(), None)
+
+        self._send(frame)
+
+    def message_key(self, json_data):
+        if json_data.get('type') == 'response':
+            return ('id', str(json_data['request_seq']))
+
+        if json_data.get('type') == 'event':
+            return ('event', json_data['event'])
+
+        if json_data.get('type') == 'request':
+            return ('method', json_data['command'])
+
+        return None
+
+    def _respond(self, request, success, body=None, message=None):
+        obj = {
+            'seq': next(self._ids),
+            'type': 'response',
+            'request_seq': request['seq'],
+            'command': request['command'],
+            'success': success,
+        }
+        if body is not None:
+            obj['body'] = body
+        if message is not None:
+            obj['message'] = message
+
+        self.send_reply(obj)
+
+    def on_request(self, command, handler):
+        ''' Answer the COMMAND reverse requests with the body returned by
+        HANDLER(arguments), or with an error if it raises.  '''
+
+        def answer(json_data):
+            try:
+                body = handler(json_data.get('arguments') or {})
+            except Exception as e:
+                self._respond(json_data, False, message=str(e))
+            else:
+                self._respond(json_data, True, body)
+            return True
+
+        self.add_handler(('method', command), answer)
+
+    def _answer_unhandled(self, json_data):
+        ''' Answer reverse requests nobody handles with an error, so the
+        adapter doesn't wait forever.  Return whether JSON_DATA was one.  '''
+
+        if (json_data.get('type') != 'request'
+                or ('method', json_data.get('command')) in self._handlers):
+            return False
+
+        self._respond(json_data, False,
+                      message='{} is not supported'.format(
+                          json_data.get('command')))
+        return True
+
+    def dispatch(self, json_data):
+        if not self._answer_unhandled(json_data):
+            super().dispatch(json_data)
+
+    def on_event(self, event_name, handler):
+        ''' Call HANDLER(json_data) for each EVENT_NAME event as soon as it
+        is received, see add_handler.  '''
+
+        self.add_handler(('event', event_name), handler)
+
+    def take_events(self, event_name):
+        ''' Return (and forget) the bodies of all the already received
+        EVENT_NAME events, without waiting for more.  '''
+
+        with self._lock:
+            queue = self._inbox.pop(('event', event_name), ())
+
+        pending = DebugAdapterPendingEvent(event_name)
+        return [pending.extract(json_data) for json_data in queue]
+
+    def wait_for_event(self, event_name, predicate=None, timeout=None):
+        ''' Wait for the next EVENT_NAME event for whose body PREDICATE (if
+        given) is true, and return its body.  Events of that name for which
+        it is false are dropped.  Raise TimeoutError after TIMEOUT seconds.
+        '''
+
+        pending = DebugAdapterPendingEvent(event_name)
+        key = pending.key()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        taken = []
+
+        def arrived():
+            # Called with the lock held, see wait_until.
+            json_data = self._take(key)
+            if json_data is not None:
+                taken.append(json_data)
+            return json_data is not None
+
+        while True:
+            remaining = None
+            if deadline is not None:
+                remaining = max(deadline - time.monotonic(), 0)
+
+            if not self.wait_until(arrived, remaining):
+                raise TimeoutError(
+                    'no {} event received'.format(event_name))
+
+            body = pending.extract(taken.pop())
+            if predicate is None or predicate(body):
+                return body
+
+
+class AsyncDebugAdapterTransport(async_common.AsyncJsonRpc,
+                                 DebugAdapterTransport):
+    ''' asyncio flavor of DebugAdapterTransport.  '''
+
+    def dispatch(self, json_data):
+        if not self._answer_unhandled(json_data):
+            super().dispatch(json_data)
+
+    async def wait_for_event(self, event_name, predicate=None, timeout=None):
+        pending = DebugAdapterPendingEvent(event_name)
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            remaining = None
+            if deadline is not None:
+                remaining = max(deadline - time.monotonic(), 0)
+
+            try:
+                body = await asyncio.wait_for(self.wait_for(pending),
+                                              remaining)
+            except asyncio.TimeoutError:
+                raise TimeoutError(
+                    'no {} event received'.format(event_name)) from None
+
+            if predicate is None or predicate(body):
+                return body
+
 
 class Initialize(Base):
 
@@ -43,6 +240,7 @@ class Initialize(Base):
         return {
             'adapterID': 'da_interact',
             'pathFormat': 'path',
+            'supportsRunInTerminalRequest': True,
         }
 
 
@@ -72,6 +270,17 @@ class Attach(Base):
         }
 
 
+class Cancel(Base):
+    def __init__(self, request_id):
+        super().__init__('cancel')
+        self._request_id = request_id
+
+    def get_params(self):
+        return {
+            'requestId': self._request_id,
+        }
+
+
 class Threads(Base):
     def __init__(self):
         super().__init__('threads')
@@ -81,9 +290,80 @@ class Threads(Base):
 
 
 class StackTrace(Base):
-    def __init__(self, thread_id):
+    def __init__(self, thread_id, levels=None):
         super().__init__('stackTrace')
         self._thread_id = thread_id
+        self._levels = levels
+
+    def get_params(self):
+        obj = {
+            'threadId': self._thread_id,
+        }
+        if self._levels is not None:
+            obj['levels'] = self._levels
+
+        return obj
+
+
+class Scopes(Base):
+    def __init__(self, frame_id):
+        super().__init__('scopes')
+        self._frame_id = frame_id
+
+    def get_params(self):
+        return {
+            'frameId': self._frame_id,
+        }
+
+
+class Variables(Base):
+    ''' Children of VARIABLES_REFERENCE (a scope or a structured variable),
+    optionally only the 'named' or 'indexed' ones (FILTER), COUNT of them
+    from START.  '''
+
+    def __init__(self, variables_reference, filter_=None, start=None,
+                 count=None):
+        super().__init__('variables')
+        self._variables_reference = variables_reference
+        self._filter = filter_
+        self._start = start
+        self._count = count
+
+    def get_params(self):
+        obj = {
+            'variablesReference': self._variables_reference,
+        }
+        for name, value in (('filter', self._filter), ('start', self._start),
+                            ('count', self._count)):
+            if value is not None:
+                obj[name] = value
+
+        return obj
+
+
+class Evaluate(Base):
+    def __init__(self, expression, frame_id=None, context=None):
+        super().__init__('evaluate')
+        self._expression = expression
+        self._frame_id = frame_id
+        self._context = context
+
+    def get_params(self):
+        obj = {
+            'expression': self._expression,
+        }
+        if self._frame_id is not None:
+            obj['frameId'] = self._frame_id
+        if self._context is not None:
+            obj['context'] = self._context
+
+        return obj
+
+
+class Continue(Base):
+    def __init__(self, thread_id):
+        super().__init__('continue')
+        self._thread_id = thread_id
 
     def get_params(self):
         return {
@@ -91,7 +371,43 @@ class StackTrace(Base):
         }
 
 
-def run(interact_cb, args_cb=None):
+class Next(Base):
+    def __init__(self, thread_id):
+        super().__init__('next')
+        self._thread_id = thread_id
+
+    def get_params(self):
+        return {
+            'threadId': self._thread_id,
+        }
+
+
+class Disconnect(Base):
+    ''' Detach from the debuggee, leaving it running unless
+    TERMINATE_DEBUGGEE.  '''
+
+    def __init__(self, terminate_debuggee=False):
+        super().__init__('disconnect')
+        self._terminate_debuggee = terminate_debuggee
+
+    def get_params(self):
+        return {
+            'terminateDebuggee': self._terminate_debuggee,
+        }
+
+
+class Pause(Base):
+    def __init__(self, thread_id):
+        super().__init__('pause')
+        self._thread_id = thread_id
+
+    def get_params(self):
+        return {
+            'threadId': self._thread_id,
+        }
+
+
+def parse_args(args_cb=None):
     argparser = argparse.ArgumentParser()
     argparser.add_argument('server',
                            help=('server executable (may contain additional '
@@ -100,21 +416,103 @@ def run(interact_cb, args_cb=None):
                            help='print communication with the server')
     argparser.add_argument('--log-pretty', action='store_true',
                            help='when --log is enabled, pretty-print the json')
-    args_cb(argparser)
-    args = argparser.parse_args()
+    argparser.add_argument('--log-file', metavar='FILE',
+                           help=('write the communication with the server '
+                                 'to FILE, as JSON lines'))
+    argparser.add_argument('--log-truncate', metavar='N', type=int,
+                           default=20000,
+                           help=('when printing the communication, truncate '
+                                 'messages longer than N characters '
+                                 '(default: %(default)s)'))
+    argparser.add_argument('--json-codec', default='auto',
+                           choices=['auto'] + list(common.CODECS),
+                           help=('JSON library used to encode and decode '
+                                 'messages (default: the fastest installed)'))
+    argparser.add_argument('--request-timeout', metavar='SECONDS',
+                           type=float,
+                           help=('cancel requests not replied to within '
+                                 'SECONDS and raise RequestTimeout'))
+    argparser.add_argument('--record', metavar='FILE',
+                           help=('record all messages in trace FILE, to be '
+                                 'replayed with replay_server.py'))
+    if args_cb:
+        args_cb(argparser)
+    return argparser.parse_args()
 
+
+def run(interact_cb, args_cb=None):
+    args = parse_args(args_cb)
+
+    logger = common.MessageLogger.from_args(args)
     server = common.start_tool(args.server)
     json_rpc = DebugAdapterTransport(server.stdin, server.stdout, args.log,
-                                     args.log_pretty)
+                                     args.log_pretty, logger=logger)
+    json_rpc.codec = common.make_codec(args.json_codec)
+
+    if args.record:
+        json_rpc.recorder = session_trace.TraceRecorder(args.record)
 
     p = json_rpc.request(Initialize())
-    json_rpc.wait_for(p)
+    json_rpc.server_capabilities = json_rpc.wait_for(p)
 
     # json_rpc.notify(Initialized())
 
+    json_rpc.default_timeout = args.request_timeout
+
     interact_cb(json_rpc, args)
 
+    if logger is not None:
+        logger.close()
+
+    if args.record:
+        json_rpc.recorder.close()
+
     # p = json_rpc.request(Shutdown())
     # r = json_rpc.wait_for(p)
 
     # json_rpc.notify(Exit())
+
+
+async def start_async(server, log=False, log_pretty=False, recorder=None,
+                      logger=None, codec=None):
+    ''' Start the debug adapter SERVER and initialize it, return an
+    AsyncDebugAdapterTransport.  '''
+
+    proc = await async_common.start_tool_async(server)
+    json_rpc = AsyncDebugAdapterTransport(proc.stdin, proc.stdout, log,
+                                          log_pretty, logger)
+    json_rpc.recorder = recorder
+    if codec is not None:
+        json_rpc.codec = codec
+
+    json_rpc.server_capabilities = await json_rpc.request(Initialize())
+
+    return json_rpc
+
+
+def run_async(interact_cb, args_cb=None):
+    ''' Like run, but INTERACT_CB is a coroutine function receiving an
+    AsyncDebugAdapterTransport.  '''
+
+    args = parse_args(args_cb)
+
+    async def main():
+        recorder = None
+        if args.record:
+            recorder = session_trace.TraceRecorder(args.record)
+
+        logger = common.MessageLogger.from_args(args)
+        json_rpc = await start_async(args.server, args.log, args.log_pretty,
+                                     recorder, logger,
+                                     common.make_codec(args.json_codec))
+        json_rpc.default_timeout = args.request_timeout
+        await interact_cb(json_rpc, args)
+        await json_rpc.close()
+
+        if logger is not None:
+            logger.close()
+
+        if recorder is not None:
+            recorder.close()
+
+    asyncio.run(main())
@@ -0,0 +1,170 @@
+#
+# Poor man's sampling profiler, through any debug adapter: attach to a
+# process, then repeatedly pause it, get the stack of every thread and let
+# it continue.  The samples are written as collapsed stacks, ready for
+# flamegraph.pl, and the time the process spent stopped for each sample is
+# reported.
+#
+# To profile the "loop" program (see test_code_debug.py):
+#
+#   python3 da_profile.py --frequency 20 --duration 10 --output loop.folded \
+#       "node ./code-debug/out/src/gdb.js" <pid>
+#   flamegraph.pl loop.folded > loop.svg
+#
+
+import collections
+import time
+
+import da_interact as da
+from stats import percentile
+
+
+class Profiler:
+    ''' Take samples of the stacks of the process RPC is attached to.  '''
+
+    def __init__(self, rpc, max_depth=None, stop_timeout=5.0):
+        self._rpc = rpc
+        self._max_depth = max_depth
+        self._stop_timeout = stop_timeout
+        # Collapsed stack -> number of samples.
+        self.stacks = collections.Counter()
+        # Time the process was stopped for each sample, in seconds.
+        self.overheads = []
+        self.failed = 0
+        self._stopped = False
+        # Threads seen at the last sample.
+        self._threads = None
+
+        # Nobody reads those, don't let them pile up.
+        rpc.on_event('output', lambda json_data: True)
+        rpc.on_event('continued', lambda json_data: True)
+
+    def wait_stopped(self, timeout):
+        ''' Wait for a stopped event (e.g. after attaching), return whether
+        one came.  '''
+
+        try:
+            self._rpc.wait_for_event('stopped', timeout=timeout)
+        except TimeoutError:
+            return False
+
+        self._stopped = True
+        return True
+
+    def sample(self):
+        ''' Pause the process (unless it's already stopped), record the stack
+        of every thread and let it continue.  '''
+
+        rpc = self._rpc
+        start = time.monotonic()
+
+        if not self._stopped:
+            # Stale stopped events would make us think it's already paused.
+            rpc.take_events('stopped')
+            if self._threads is None:
+                self._threads = rpc.wait_for(
+                    rpc.request(da.Threads()))['threads']
+            rpc.wait_for(rpc.request(da.Pause(self._threads[0]['id'])))
+            if not self.wait_stopped(self._stop_timeout):
+                self.failed += 1
+                return
+
+        threads = rpc.wait_for(rpc.request(da.Threads()))['threads']
+        self._threads = threads
+        traces = rpc.request_many([da.StackTrace(t['id'], self._max_depth)
+                                   for t in threads])
+
+        rpc.wait_for(rpc.request(da.Continue(threads[0]['id'])))
+        self._stopped = False
+        self.overheads.append(time.monotonic() - start)
+
+        for thread, trace in zip(threads, traces):
+            # Outermost frame first.
+            frames = [thread.get('name') or str(thread['id'])]
+            frames += [f['name'].replace(';', ':')
+                       for f in reversed(trace.get('stackFrames', []))]
+            self.stacks[';'.join(frames)] += 1
+
+    def run(self, frequency, duration=None, samples=None):
+        ''' Sample at FREQUENCY Hz, for DURATION seconds or SAMPLES samples
+        (whichever comes first).  '''
+
+        period = 1.0 / frequency
+        start = time.monotonic()
+        next_sample = start
+        count = 0
+
+        while ((duration is None or time.monotonic() - start < duration)
+               and (samples is None or count < samples)):
+            delay = next_sample - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            next_sample = max(next_sample + period, time.monotonic())
+
+            self.sample()
+            count += 1
+
+    def collapsed(self):
+        return '\n'.join('{} {}'.format(stack, count)
+                         for stack, count in sorted(self.stacks.items()))
+
+    def format_summary(self, top=10):
+        overheads = sorted(self.overheads)
+        lines = ['{} samples ({} failed), stopped per sample: '
+                 'p50 {:.2f} ms, p90 {:.2f} ms, max {:.2f} ms'.format(
+                     len(overheads), self.failed,
+                     (percentile(overheads, 50) or 0) * 1000,
+                     (percentile(overheads, 90) or 0) * 1000,
+                     (overheads[-1] if overheads else 0) * 1000)]
+
+        # Samples in which each function is at the top of a stack.
+        leaves = collections.Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+
+        total = sum(leaves.values()) or 1
+        lines.append('top frames:')
+        for name, count in leaves.most_common(top):
+            lines.append('  {:6.1f}%  {}'.format(100 * count / total, name))
+
+        return '\n'.join(lines)
+
+
+def interact(rpc, args):
+    rpc.wait_for(rpc.request(da.Attach(args.pid)))
+
+    profiler = Profiler(rpc, args.max_depth)
+    # Some adapters stop the process when attaching.
+    profiler.wait_stopped(0.5)
+
+    profiler.run(args.frequency, args.duration, args.samples)
+
+    rpc.wait_for(rpc.request(da.Disconnect()))
+
+    print(profiler.format_summary())
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(profiler.collapsed() + '\n')
+
+
+def args_cb(argparser):
+    argparser.add_argument('pid', type=int)
+    argparser.add_argument('--frequency', type=float, default=10,
+                           help='samples per second (default: %(default)s)')
+    argparser.add_argument('--duration', type=float, default=10,
+                           help='seconds to sample for (default: %(default)s)')
+    argparser.add_argument('--samples', type=int,
+                           help='stop after this many samples')
+    argparser.add_argument('--max-depth', type=int,
+                           help='frames per stack (default: all)')
+    argparser.add_argument('--output', metavar='FILE',
+                           help='write the collapsed stacks to FILE')
+
+
+def main():
+    da.run(interact, args_cb)
+
+
+if __name__ == '__main__':
+    main()
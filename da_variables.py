@@ -0,0 +1,275 @@
+#
+# Lazy view of the stacks and variables of a stopped debuggee.
+#
+# A VariableTree fetches the stack frames, scopes and variables through a
+# DebugAdapterTransport only when they are looked at, and remembers them
+# until the debuggee runs again (continued, stopped or invalidated event):
+# variablesReference values are only valid while it is stopped anyway.
+#
+# The requests for siblings (the stacks of several threads, the scopes of
+# all frames, the children of all the variables of one level) are sent
+# back-to-back, so dumping the locals of a deep stack costs one round trip
+# per level of the tree instead of one per node:
+#
+#   tree = da_variables.VariableTree(json_rpc)
+#   for frame, scopes in tree.locals(thread_id, depth=2):
+#       print(frame['name'], [var.name for var in scopes[0].children()])
+#
+# Run this file to dump the locals of every frame of a process:
+#
+#   python3 da_variables.py --depth 2 "node ./code-debug/out/src/gdb.js" <pid>
+#
+
+import threading
+
+import da_interact as da
+
+
+class Variable:
+    ''' A variable, scope or evaluation result.  Its children are fetched
+    by the first call to children().  '''
+
+    def __init__(self, tree, generation, name, value=None, reference=0,
+                 type_=None, evaluate_name=None, expensive=False):
+        self._tree = tree
+        self.generation = generation
+        self.name = name
+        self.value = value
+        self.reference = reference
+        self.type = type_
+        self.evaluate_name = evaluate_name
+        self.expensive = expensive
+
+    @classmethod
+    def from_dap(cls, tree, generation, obj, name=None):
+        # Variables have a value, evaluate results a result, scopes none.
+        return cls(tree, generation, obj.get('name', name),
+                   obj.get('value', obj.get('result')),
+                   obj.get('variablesReference', 0), obj.get('type'),
+                   obj.get('evaluateName'), obj.get('expensive', False))
+
+    def expandable(self):
+        return self.reference > 0
+
+    def children(self, fetch=True):
+        ''' Return the children of this variable (an empty list if it has
+        none).  If they are not fetched yet and not FETCH, return None.  '''
+
+        return self._tree.children(self, fetch)
+
+    def __repr__(self):
+        return 'Variable({!r}, {!r})'.format(self.name, self.value)
+
+
+class VariableTree:
+    def __init__(self, json_rpc, window=None):
+        self._json_rpc = json_rpc
+        # Requests in flight at once when fetching siblings.
+        self._window = window
+        self._lock = threading.Lock()
+        # Request key -> reply body, for the current stop.
+        self._cache = {}
+        # Number of invalidations, replies to requests sent before one are
+        # not cached and variables from before one can't be expanded.
+        self.generation = 0
+        self.requests = 0
+        self.round_trips = 0
+
+        for event_name in ('stopped', 'continued', 'invalidated'):
+            json_rpc.on_event(event_name, self._on_run)
+
+    def _on_run(self, json_data):
+        self.invalidate()
+        # Leave the event to whoever waits for it.
+        return False
+
+    def invalidate(self):
+        with self._lock:
+            self._cache = {}
+            self.generation += 1
+
+    def _fetch(self, reqs):
+        ''' Return the reply bodies of REQS, a list of (key, request),
+        sending the requests whose reply is not cached back-to-back.  '''
+
+        with self._lock:
+            cache = self._cache
+            generation = self.generation
+
+        bodies = {key: cache[key] for key, _ in reqs if key in cache}
+        missing = {key: req for key, req in reqs if key not in bodies}
+
+        if missing:
+            replies = self._json_rpc.request_many(missing.values(),
+                                                  self._window)
+            self.requests += len(missing)
+            self.round_trips += 1
+            bodies.update(zip(missing, replies))
+
+            with self._lock:
+                if self.generation == generation:
+                    for key in missing:
+                        cache[key] = bodies[key]
+
+        return [bodies[key] for key, _ in reqs]
+
+    def threads(self):
+        body, = self._fetch([(('threads',), da.Threads())])
+        return body.get('threads', [])
+
+    def stacks(self, thread_ids, levels=None):
+        ''' Return the frames of each thread of THREAD_IDS (innermost
+        first), at most LEVELS of them.  '''
+
+        bodies = self._fetch([(('stackTrace', thread_id, levels),
+                               da.StackTrace(thread_id, levels))
+                              for thread_id in thread_ids])
+        return [body.get('stackFrames', []) for body in bodies]
+
+    def stack(self, thread_id, levels=None):
+        return self.stacks([thread_id], levels)[0]
+
+    def scopes_many(self, frame_ids):
+        ''' Return the scopes (Variable objects) of each frame of
+        FRAME_IDS.  '''
+
+        generation = self.generation
+        bodies = self._fetch([(('scopes', frame_id), da.Scopes(frame_id))
+                              for frame_id in frame_ids])
+        return [[Variable.from_dap(self, generation, scope)
+                 for scope in body.get('scopes', [])]
+                for body in bodies]
+
+    def scopes(self, frame_id):
+        return self.scopes_many([frame_id])[0]
+
+    def _check(self, variable):
+        if variable.generation != self.generation:
+            raise ValueError('{!r} is from a previous stop'.format(variable))
+
+    def children(self, variable, fetch=True):
+        self._check(variable)
+        if not variable.expandable():
+            return []
+
+        key = ('variables', variable.reference)
+        if not fetch and key not in self._cache:
+            return None
+
+        generation = self.generation
+        body, = self._fetch([(key, da.Variables(variable.reference))])
+        return [Variable.from_dap(self, generation, obj)
+                for obj in body.get('variables', [])]
+
+    def expand(self, variables, depth=1, include_expensive=False):
+        ''' Fetch the children of VARIABLES, down to DEPTH levels, one round
+        trip per level.  Expensive scopes are skipped unless
+        INCLUDE_EXPENSIVE.  '''
+
+        level = list(variables)
+        for _ in range(depth):
+            for variable in level:
+                self._check(variable)
+            level = [variable for variable in level
+                     if variable.expandable()
+                     and (include_expensive or not variable.expensive)]
+            if not level:
+                break
+
+            self._fetch([(('variables', variable.reference),
+                          da.Variables(variable.reference))
+                         for variable in level])
+            level = [child for variable in level
+                     for child in variable.children()]
+
+    def locals(self, thread_id, depth=1, levels=None,
+               include_expensive=False):
+        ''' Return a list of (frame, scopes) for the frames of THREAD_ID,
+        with DEPTH levels of variables fetched under the scopes.  '''
+
+        frames = self.stack(thread_id, levels)
+        scopes = self.scopes_many([frame['id'] for frame in frames])
+        self.expand([scope for frame_scopes in scopes
+                     for scope in frame_scopes], depth, include_expensive)
+
+        return list(zip(frames, scopes))
+
+    def evaluate(self, expression, frame_id=None, context='watch'):
+        ''' Evaluate EXPRESSION in the frame FRAME_ID, return a Variable.
+        The result is cached, except in the repl context where evaluating
+        may have side effects.  '''
+
+        generation = self.generation
+        req = da.Evaluate(expression, frame_id, context)
+        if context == 'repl':
+            body = self._json_rpc.wait_for(self._json_rpc.request(req))
+            self.requests += 1
+            self.round_trips += 1
+        else:
+            body, = self._fetch([(('evaluate', expression, frame_id,
+                                   context), req)])
+
+        return Variable.from_dap(self, generation, body, expression)
+
+
+def format_variables(variables, indent=0):
+    ''' Return the lines of VARIABLES and of their children already fetched.
+    '''
+
+    lines = []
+    for variable in variables:
+        line = '{}{}'.format('  ' * indent, variable.name)
+        if variable.value is not None:
+            line += ' = {}'.format(variable.value)
+        lines.append(line)
+
+        children = variable.children(fetch=False)
+        if children:
+            lines += format_variables(children, indent + 1)
+
+    return lines
+
+
+def interact(json_rpc, args):
+    json_rpc.on_event('output', lambda json_data: True)
+    json_rpc.wait_for(json_rpc.request(da.Attach(args.pid)))
+
+    tree = VariableTree(json_rpc, args.window)
+    try:
+        # Some adapters stop the process when attaching.
+        json_rpc.wait_for_event('stopped', timeout=0.5)
+    except TimeoutError:
+        thread_id = tree.threads()[0]['id']
+        json_rpc.wait_for(json_rpc.request(da.Pause(thread_id)))
+        json_rpc.wait_for_event('stopped', timeout=5)
+
+    for thread in tree.threads():
+        print('thread {} ({})'.format(thread['id'], thread.get('name')))
+        for frame, scopes in tree.locals(thread['id'], args.depth,
+                                         args.levels):
+            print('  #{} {}'.format(frame['id'], frame['name']))
+            print('\n'.join(format_variables(scopes, 2)))
+
+    print('{} requests in {} round trips'.format(tree.requests,
+                                                 tree.round_trips))
+
+    json_rpc.wait_for(json_rpc.request(da.Disconnect()))
+
+
+def args_cb(argparser):
+    argparser.add_argument('pid', type=int)
+    argparser.add_argument('--depth', type=int, default=1,
+                           help=('levels of variables to fetch under each '
+                                 'scope (default: %(default)s)'))
+    argparser.add_argument('--levels', type=int,
+                           help='frames per thread (default: all)')
+    argparser.add_argument('--window', type=int,
+                           help='requests in flight (default: no limit)')
+
+
+def main():
+    da.run(interact, args_cb)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+import threading
+import time
+
+
+def to_uri(path_or_uri):
+    if '://' in path_or_uri:
+        return path_or_uri
+
+    return 'file://' + path_or_uri
+
+
+class DiagnosticsStore:
+    ''' Index of the diagnostics published by the server, by URI.
+
+    It is updated as publishDiagnostics notifications are received.  By
+    default it consumes them, so they are no longer available to
+    json_rpc.wait_for (pass consume=False to keep them).
+
+    Call expect() when sending a didOpen or didChange (DocumentStore does
+    it) to measure the time until the first and the last diagnostics for
+    that version of the document.  '''
+
+    def __init__(self, json_rpc, consume=True):
+        self._json_rpc = json_rpc
+        self._consume = consume
+        self._lock = threading.Lock()
+        # uri -> (version, diagnostics) of the last publish.
+        self._diags = {}
+        # uri -> number of publishes received since the last expect().
+        self._reported = {}
+        # uri -> expected version (None if unknown) of the last expect().
+        self._expected = {}
+        # uri -> timing entry of the last expect().
+        self._timing = {}
+        # All the timing entries, in expect() order.
+        self._timings = []
+
+        json_rpc.on_notification('textDocument/publishDiagnostics',
+                                 self._on_publish)
+
+    def expect(self, uri, version=None):
+        ''' Note that a didOpen or didChange for URI (at VERSION) was just
+        sent: diagnostics are expected for it.  '''
+
+        uri = to_uri(uri)
+        entry = {
+            'uri': uri,
+            'version': version,
+            'sent': time.monotonic(),
+            'first': None,
+            'final': None,
+            'count': 0,
+        }
+
+        with self._lock:
+            self._expected[uri] = version
+            self._reported[uri] = 0
+            self._timing[uri] = entry
+            self._timings.append(entry)
+
+    def _on_publish(self, json_data):
+        now = time.monotonic()
+        params = json_data['params']
+        uri = params['uri']
+        version = params.get('version')
+
+        with self._lock:
+            self._diags[uri] = (version, params['diagnostics'])
+
+            expected = self._expected.get(uri)
+            if (expected is None or version is None
+                    or version >= expected):
+                self._reported[uri] = self._reported.get(uri, 0) + 1
+
+                entry = self._timing.get(uri)
+                if entry is not None:
+                    if entry['first'] is None:
+                        entry['first'] = now - entry['sent']
+                    entry['final'] = now - entry['sent']
+                    entry['count'] += 1
+
+        return self._consume
+
+    def get(self, uri):
+        ''' Return the last diagnostics published for URI, or None.  '''
+
+        entry = self._diags.get(to_uri(uri))
+        return entry[1] if entry is not None else None
+
+    def version(self, uri):
+        ''' Return the document version of the last diagnostics published
+        for URI, or None.  '''
+
+        entry = self._diags.get(to_uri(uri))
+        return entry[0] if entry is not None else None
+
+    def _has_reported(self, uri):
+        return self._reported.get(uri, 0) > 0
+
+    def _reported_among(self, uris):
+        with self._lock:
+            return {uri for uri in uris if self._has_reported(uri)}
+
+    def _wait(self, uris, done, timeout):
+        if not self._json_rpc.wait_until(
+                lambda: done(self._reported_among(uris)), timeout):
+            raise TimeoutError(
+                'no diagnostics received for: {}'.format(
+                    ', '.join(sorted(set(uris)
+                                     - self._reported_among(uris)))))
+
+        return self._reported_among(uris)
+
+    def wait_for_diagnostics(self, uris, timeout=None):
+        ''' Wait until diagnostics were published for every URI in URIS
+        (paths are accepted too) since the last expect() for it, and return
+        a dict uri -> diagnostics.  Raise TimeoutError after TIMEOUT
+        seconds.  '''
+
+        uris = [to_uri(u) for u in uris]
+        self._wait(uris, lambda reported: len(reported) == len(set(uris)),
+                   timeout)
+
+        return {uri: self.get(uri) for uri in uris}
+
+    def wait_for_any(self, uris, timeout=None):
+        ''' Wait until diagnostics were published for at least one URI in
+        URIS, return the set of URIs that have reported.  '''
+
+        uris = [to_uri(u) for u in uris]
+        return self._wait(uris, bool, timeout)
+
+    def timings(self):
+        ''' Return the timing entries, one per expect(): the time from the
+        didOpen/didChange to the first and to the last diagnostics received
+        so far (in seconds, None if none), and the number of publishes.  '''
+
+        with self._lock:
+            return [dict(entry) for entry in self._timings]
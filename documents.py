@@ -0,0 +1,250 @@
+import glob
+import os
+
+import common
+import ls_interact as ls
+
+# Values of TextDocumentSyncKind.
+SYNC_NONE = 0
+SYNC_FULL = 1
+SYNC_INCREMENTAL = 2
+
+
+def sync_kind(capabilities):
+    ''' Return the TextDocumentSyncKind advertised in the server
+    CAPABILITIES.  '''
+
+    sync = (capabilities or {}).get('textDocumentSync', SYNC_NONE)
+    if isinstance(sync, dict):
+        return sync.get('change', SYNC_NONE)
+
+    return sync
+
+
+def _common_prefix_len(a, b):
+    ''' Length of the common prefix of strings A and B.
+
+    Compare slices of decreasing size rather than characters one by one, so
+    most of the work happens in C.  That matters for multi-megabyte
+    documents.  '''
+
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+
+    return lo
+
+
+def _common_suffix_len(a, b, limit):
+    ''' Length of the common suffix of strings A and B, at most LIMIT.  '''
+
+    lo, hi = 0, min(len(a), len(b), limit)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a) - mid:len(a) - lo] == b[len(b) - mid:len(b) - lo]:
+            lo = mid
+        else:
+            hi = mid - 1
+
+    return lo
+
+
+def offset_to_position(text, offset):
+    ''' Convert OFFSET in TEXT to an LSP position (0-based line, character
+    in UTF-16 code units).  '''
+
+    line = text.count('\n', 0, offset)
+    line_start = text.rfind('\n', 0, offset) + 1
+    segment = text[line_start:offset]
+
+    if segment.isascii():
+        character = len(segment)
+    else:
+        character = len(segment.encode('utf-16-le')) // 2
+
+    return {'line': line, 'character': character}
+
+
+def compute_change(old, new):
+    ''' Return the content change (a dict with 'range' and 'text') turning
+    OLD into NEW, replacing as little text as possible.  Return None if OLD
+    and NEW are equal.  '''
+
+    if old == new:
+        return None
+
+    prefix = _common_prefix_len(old, new)
+    suffix = _common_suffix_len(old, new,
+                                min(len(old), len(new)) - prefix)
+
+    return {
+        'range': {
+            'start': offset_to_position(old, prefix),
+            'end': offset_to_position(old, len(old) - suffix),
+        },
+        'text': new[prefix:len(new) - suffix],
+    }
+
+
+def iter_paths(pattern):
+    ''' Lazily yield the absolute paths of the files matching PATTERN:
+    either a directory, searched recursively for files with a known
+    extension, or a glob pattern (** is supported).  '''
+
+    if os.path.isdir(pattern):
+        for dirpath, dirnames, filenames in os.walk(pattern):
+            dirnames.sort()
+            for name in sorted(filenames):
+                if os.path.splitext(name)[1].lower() in ls.LANGUAGE_IDS:
+                    yield os.path.abspath(os.path.join(dirpath, name))
+    else:
+        for path in glob.iglob(pattern, recursive=True):
+            if os.path.isfile(path):
+                yield os.path.abspath(path)
+
+
+class Document:
+    __slots__ = ('path', 'text', 'version')
+
+    def __init__(self, path, text, version):
+        self.path = path
+        self.text = text
+        self.version = version
+
+
+class DocumentStore:
+    ''' Keep track of the text and version of the documents open in the
+    server, and send didOpen/didChange/didClose notifications for them.
+
+    Changes are sent as incremental range edits if the server supports
+    them, in full otherwise.  The methods return what json_rpc.notify
+    returns, so they must be awaited with an AsyncJsonRpc.
+
+    If DIAGNOSTICS (a diagnostics.DiagnosticsStore) is given, it is told
+    about every didOpen and didChange sent.  '''
+
+    def __init__(self, json_rpc, diagnostics=None):
+        self._json_rpc = json_rpc
+        self._diagnostics = diagnostics
+        self._docs = {}
+        self._full_sync = (sync_kind(json_rpc.server_capabilities)
+                           != SYNC_INCREMENTAL)
+
+    def __contains__(self, path):
+        return path in self._docs
+
+    def get(self, path):
+        return self._docs.get(path)
+
+    def open(self, path, text=None, keep_text=True):
+        ''' Open the document at PATH, with content TEXT (read from the file
+        if None).  If KEEP_TEXT is false, the text is not kept in the store
+        and changes to that document are sent as full text.  '''
+
+        if text is None:
+            with open(path) as f:
+                text = f.read()
+
+        self._docs[path] = Document(path, text if keep_text else None, 1)
+
+        if self._diagnostics is not None:
+            self._diagnostics.expect(path, 1)
+
+        return self._json_rpc.notify(ls.DidOpenTextDocument(path, text, 1))
+
+    def change(self, path, text):
+        ''' Replace the content of the open document at PATH with TEXT.  '''
+
+        doc = self._docs[path]
+
+        if self._full_sync or doc.text is None:
+            notif = ls.DidChangeTextDocument(path, text, doc.version + 1)
+        else:
+            change = compute_change(doc.text, text)
+            if change is None:
+                return None
+
+            notif = ls.DidChangeTextDocument(path, version=doc.version + 1,
+                                             changes=[change])
+
+        if doc.text is not None:
+            doc.text = text
+        doc.version += 1
+
+        if self._diagnostics is not None:
+            self._diagnostics.expect(path, doc.version)
+
+        return self._json_rpc.notify(notif)
+
+    def close(self, path):
+        del self._docs[path]
+
+        return self._json_rpc.notify(ls.DidCloseTextDocument(path))
+
+    def open_many(self, pattern, max_in_flight=32, memory_budget=64 << 20,
+                  keep_text=False, on_diagnostics=None):
+        ''' Open all the files matching PATTERN (see iter_paths).
+
+        Files are read one at a time, as they are opened.  At most
+        MAX_IN_FLIGHT documents, totalling at most MEMORY_BUDGET bytes, are
+        awaiting their first diagnostics at any time; once the limit is
+        reached, we wait for diagnostics before opening more.
+        ON_DIAGNOSTICS(path, params) is called for the first diagnostics of
+        each document.  Returns the number of documents opened.
+
+        Unless KEEP_TEXT, the text of the documents is not kept (see open):
+        the memory budget only bounds what the server has to parse.
+
+        This waits for diagnostics with the diagnostics store if there is
+        one, with wait_for otherwise.  Either way it only works with the
+        synchronous JsonRpc.  '''
+
+        pending_method = common.JsonRpc.JsonRpcPendingMethod(
+            'textDocument/publishDiagnostics')
+        # uri -> (path, size) for the documents awaiting diagnostics.
+        awaiting = {}
+        awaiting_bytes = 0
+        count = 0
+
+        def wait_one():
+            nonlocal awaiting_bytes
+
+            if self._diagnostics is not None:
+                reported = self._diagnostics.wait_for_any(list(awaiting))
+                received = [{
+                    'uri': uri,
+                    'diagnostics': self._diagnostics.get(uri),
+                } for uri in reported]
+            else:
+                while True:
+                    params = self._json_rpc.wait_for(pending_method)
+                    if params['uri'] in awaiting:
+                        received = [params]
+                        break
+
+            for params in received:
+                path, size = awaiting.pop(params['uri'])
+                awaiting_bytes -= size
+                if on_diagnostics is not None:
+                    on_diagnostics(path, params)
+
+        for path in iter_paths(pattern):
+            size = os.path.getsize(path)
+
+            while awaiting and (len(awaiting) >= max_in_flight
+                                or awaiting_bytes + size > memory_budget):
+                wait_one()
+
+            self.open(path, keep_text=keep_text)
+            awaiting['file://' + path] = (path, size)
+            awaiting_bytes += size
+            count += 1
+
+        while awaiting:
+            wait_one()
+
+        return count
@@ -1,10 +1,18 @@
 import argparse
+import asyncio
+import async_common
 import common
-import re
+import os
+import resource_sampler
+import response_cache
+import results
+import session_trace
+import stats
 from common import Base
 
 
 class Range:
+    __slots__ = ('_sl', '_sc', '_el', '_ec')
 
     def __init__(self, start_line, start_col, end_line, end_col):
         self._sl = start_line
@@ -41,6 +49,40 @@ class Range:
         return self._ec - 1
 
 
+# languageId to use for each file extension.
+LANGUAGE_IDS = {
+    '.c': 'c',
+    '.cpp': 'cpp',
+    '.cc': 'cpp',
+    '.cxx': 'cpp',
+    '.h': 'cpp',
+    '.hh': 'cpp',
+    '.hpp': 'cpp',
+    '.go': 'go',
+    '.ts': 'typescript',
+    '.tsx': 'typescript',
+    '.calc': 'calc',
+}
+
+
+def language_id(path):
+    ''' Guess the languageId of the file at PATH from its extension.  '''
+
+    # We've always used cpp for everything, keep it for the unknown.
+    return LANGUAGE_IDS.get(os.path.splitext(path)[1].lower(), 'cpp')
+
+
+class TextDocumentBase(Base):
+    ''' Base for the messages about one text document.  '''
+
+    def __init__(self, method_name, path):
+        super().__init__(method_name)
+        self._path = path
+
+    def get_path(self):
+        return self._path
+
+
 class Initialize(Base):
 
     def __init__(self, params):
@@ -78,21 +120,28 @@ class Exit(Base):
         return {}
 
 
-class DidOpenTextDocument(Base):
+class DidOpenTextDocument(TextDocumentBase):
 
-    def __init__(self, path):
-        super().__init__('textDocument/didOpen')
-        self._path = path
+    def __init__(self, path, text=None, version=1, language=None):
+        super().__init__('textDocument/didOpen', path)
+        self._text = text
+        self._version = version
+        self._language = language or language_id(path)
+
+    def get_version(self):
+        return self._version
 
     def get_params(self):
-        with open(self._path) as f:
-            data = f.read()
+        data = self._text
+        if data is None:
+            with open(self._path) as f:
+                data = f.read()
 
         obj = {}
         obj['textDocument'] = {}
         obj['textDocument']['uri'] = 'file://' + self._path
-        obj['textDocument']['languageId'] = 'cpp'
-        obj['textDocument']['version'] = 1
+        obj['textDocument']['languageId'] = self._language
+        obj['textDocument']['version'] = self._version
         obj['textDocument']['text'] = data
 #        obj['metadata'] = {}
 #        obj['metadata']['extraFlags'] = ['-xc++']
@@ -100,11 +149,10 @@ class DidOpenTextDocument(Base):
         return obj
 
 
-class DidCloseTextDocument(Base):
+class DidCloseTextDocument(TextDocumentBase):
 
     def __init__(self, path):
-        super().__init__('textDocument/didClose')
-        self._path = path
+        super().__init__('textDocument/didClose', path)
 
     def get_params(self):
         obj = {}
@@ -113,29 +161,40 @@ class DidCloseTextDocument(Base):
         return obj
 
 
-class DidChangeTextDocument(Base):
+class DidChangeTextDocument(TextDocumentBase):
+    ''' Send TEXT as the new full content of the document, or, if CHANGES
+    is given, send these content changes (each a dict with 'range' and
+    'text') instead.  '''
 
-    def __init__(self, path, text):
-        super().__init__('textDocument/didChange')
-        self._path = path
+    def __init__(self, path, text=None, version=None, changes=None):
+        super().__init__('textDocument/didChange', path)
         self._text = text
+        self._version = version
+        self._changes = changes
+
+    def get_version(self):
+        return self._version
 
     def get_params(self):
         obj = {}
         obj['textDocument'] = {}
         obj['textDocument']['uri'] = 'file://' + self._path
-        obj['contentChanges'] = [{
-            'text': self._text,
-        }]
+        if self._version is not None:
+            obj['textDocument']['version'] = self._version
+        if self._changes is not None:
+            obj['contentChanges'] = self._changes
+        else:
+            obj['contentChanges'] = [{
+                'text': self._text,
+            }]
 
         return obj
 
 
-class GotoDefinition(Base):
+class GotoDefinition(TextDocumentBase):
 
     def __init__(self, path, line, col):
-        super().__init__('textDocument/definition')
-        self._path = path
+        super().__init__('textDocument/definition', path)
         self._line = line
         self._col = col
 
@@ -151,13 +210,15 @@ class GotoDefinition(Base):
         return obj
 
 
-class FindReferences(Base):
+class FindReferences(TextDocumentBase):
+    ''' With a PARTIAL_RESULT_TOKEN, the server may send the references in
+    chunks, see JsonRpc.stream.  '''
 
-    def __init__(self, path, line, col):
-        super().__init__('textDocument/references')
-        self._path = path
+    def __init__(self, path, line, col, partial_result_token=None):
+        super().__init__('textDocument/references', path)
         self._line = line
         self._col = col
+        self.partial_result_token = partial_result_token
 
     def get_params(self):
         obj = {}
@@ -167,15 +228,16 @@ class FindReferences(Base):
         obj['position'] = {}
         obj['position']['line'] = self._line - 1
         obj['position']['character'] = self._col - 1
+        if self.partial_result_token is not None:
+            obj['partialResultToken'] = self.partial_result_token
 
         return obj
 
 
-class CodeLens(Base):
+class CodeLens(TextDocumentBase):
 
     def __init__(self, path):
-        super().__init__('textDocument/codeLens')
-        self._path = path
+        super().__init__('textDocument/codeLens', path)
 
     def get_params(self):
         obj = {}
@@ -196,11 +258,10 @@ class CodeLensResolve(Base):
         return self._lens
 
 
-class CodeAction(Base):
+class CodeAction(TextDocumentBase):
 
     def __init__(self, path, range_, diags):
-        super().__init__('textDocument/codeAction')
-        self._path = path
+        super().__init__('textDocument/codeAction', path)
         if type(range_) == Range:
             self._range = range_.to_lsp()
         else:
@@ -220,11 +281,10 @@ class CodeAction(Base):
         return obj
 
 
-class Hover(Base):
+class Hover(TextDocumentBase):
 
     def __init__(self, path, line, col):
-        super().__init__('textDocument/hover')
-        self._path = path
+        super().__init__('textDocument/hover', path)
         self._line = line
         self._col = col
 
@@ -251,47 +311,262 @@ class DidChangeConfiguration(Base):
 
 
 class WorkspaceSymbol(Base):
+    ''' See FindReferences for PARTIAL_RESULT_TOKEN.  '''
 
-    def __init__(self, query):
+    def __init__(self, query, partial_result_token=None):
         super().__init__('workspace/symbol')
         self._query = query
+        self.partial_result_token = partial_result_token
 
     def get_params(self):
-        return {
+        obj = {
             'query': self._query
         }
+        if self.partial_result_token is not None:
+            obj['partialResultToken'] = self.partial_result_token
+
+        return obj
 
 
-def run(callback, cmdline_args="", initialize_params={}):
+def parse_args(args_cb=None):
     argparser = argparse.ArgumentParser()
     argparser.add_argument('server',
                            help=('server executable (may contain additional ' +
-                                 'args)'))
+                                 'args), or :PORT or unix:PATH to connect '
+                                 'to a running server'))
     argparser.add_argument('--log', action='store_true',
                            help='print communication with the server')
     argparser.add_argument('--log-pretty', action='store_true',
                            help='when --log is enabled, pretty-print the json')
-    args = argparser.parse_args()
-
-    m = re.match(r':(\d{1,5})', args.server)
-    if m:
-        port = int(m.group(1))
-        sock = common.connect_tool(port)
+    argparser.add_argument('--log-file', metavar='FILE',
+                           help=('write the communication with the server '
+                                 'to FILE, as JSON lines'))
+    argparser.add_argument('--log-truncate', metavar='N', type=int,
+                           default=20000,
+                           help=('when printing the communication, truncate '
+                                 'messages longer than N characters '
+                                 '(default: %(default)s)'))
+    argparser.add_argument('--reader-thread', action='store_true',
+                           help=('read the server output from a background '
+                                 'thread, request() returns futures'))
+    argparser.add_argument('--latency-report', metavar='FILE',
+                           help=('record per-method request latencies, print '
+                                 'them at shutdown and save them as JSON in '
+                                 'FILE'))
+    argparser.add_argument('--json-codec', default='auto',
+                           choices=['auto'] + list(common.CODECS),
+                           help=('JSON library used to encode and decode '
+                                 'messages (default: the fastest installed)'))
+    argparser.add_argument('--request-timeout', metavar='SECONDS',
+                           type=float,
+                           help=('cancel requests not replied to within '
+                                 'SECONDS and raise RequestTimeout'))
+    argparser.add_argument('--record', metavar='FILE',
+                           help=('record all messages in trace FILE, to be '
+                                 'replayed with replay_server.py'))
+    argparser.add_argument('--resource-report', metavar='FILE',
+                           help=('sample the memory, CPU, thread and I/O '
+                                 'usage of the server, print a timeline at '
+                                 'shutdown and save the samples as JSON in '
+                                 'FILE'))
+    argparser.add_argument('--sample-interval', metavar='SECONDS',
+                           type=float, default=0.1,
+                           help=('interval between two --resource-report '
+                                 'samples (default: %(default)s)'))
+    argparser.add_argument('--response-cache', metavar='MB', type=float,
+                           help=('cache the replies to hover, definition '
+                                 'and references requests, up to MB '
+                                 'megabytes, and print the hit rates at '
+                                 'shutdown (the callback gets a '
+                                 'response_cache.ResponseCache)'))
+    argparser.add_argument('--compact-results', action='store_true',
+                           help=('decode the results of location and '
+                                 'symbol requests straight into the compact '
+                                 'lists of results.py instead of dicts'))
+    if args_cb:
+        args_cb(argparser)
+    return argparser.parse_args()
+
+
+def run(callback, cmdline_args="", initialize_params={}, args_cb=None):
+    ''' Start (or connect to) the server, initialize it, call
+    CALLBACK(json_rpc) and shut the server down.
+
+    ARGS_CB(argparser) may add arguments of its own, CALLBACK is then called
+    with the parsed arguments as well: CALLBACK(json_rpc, args).  '''
+
+    args = parse_args(args_cb)
+    logger = common.MessageLogger.from_args(args)
+
+    address = common.socket_address(args.server)
+    if address is not None:
+        sock = common.connect_socket(address)
         json_rpc = common.JsonRpc(sock, sock, args.log,
-                                  args.log_pretty)
+                                  args.log_pretty, args.reader_thread,
+                                  logger)
     else:
         server = common.start_tool('{} {}'.format(args.server, cmdline_args))
         json_rpc = common.JsonRpc(server.stdin, server.stdout, args.log,
-                                  args.log_pretty)
+                                  args.log_pretty, args.reader_thread,
+                                  logger)
+
+        if args.resource_report:
+            json_rpc.resource_sampler = resource_sampler.ResourceSampler(
+                server.pid, args.sample_interval)
+
+    if args.resource_report and json_rpc.resource_sampler is None:
+        print('warning: --resource-report needs a server command line, '
+              'not a port')
+
+    sampler = json_rpc.resource_sampler
+
+    json_rpc.codec = common.make_codec(args.json_codec)
+
+    if args.compact_results:
+        json_rpc.result_decoders = results.raw_decoders()
+
+    if args.latency_report:
+        json_rpc.stats = stats.LatencyStats()
+
+    if args.record:
+        json_rpc.recorder = session_trace.TraceRecorder(args.record)
 
     p = json_rpc.request(Initialize(initialize_params))
-    json_rpc.wait_for(p)
+    r = json_rpc.wait_for(p)
+    json_rpc.server_capabilities = r.get('capabilities', {})
 
     json_rpc.notify(Initialized())
 
-    callback(json_rpc)
+    json_rpc.default_timeout = args.request_timeout
+
+    if sampler is not None:
+        sampler.mark('initialized')
+
+    callback_args = (args,) if args_cb else ()
+
+    if args.response_cache is not None:
+        cache = response_cache.ResponseCache(
+            json_rpc, int(args.response_cache * 1e6))
+        callback(cache, *callback_args)
+        print(cache.format_stats())
+    else:
+        callback(json_rpc, *callback_args)
+
+    if sampler is not None:
+        sampler.mark('shutdown')
 
     p = json_rpc.request(Shutdown())
     json_rpc.wait_for(p)
 
     json_rpc.notify(Exit())
+
+    if sampler is not None:
+        sampler.stop()
+        print(sampler.format_timeline())
+
+        with open(args.resource_report, 'w') as f:
+            f.write(sampler.to_json())
+
+    if logger is not None:
+        logger.close()
+
+    if args.record:
+        json_rpc.recorder.close()
+
+    if args.latency_report:
+        write_latency_report(json_rpc.stats, args.latency_report)
+
+
+def write_latency_report(latency_stats, path):
+    print(latency_stats.format_table())
+
+    with open(path, 'w') as f:
+        f.write(latency_stats.to_json())
+
+
+async def start_async(server, cmdline_args="", initialize_params={},
+                      log=False, log_pretty=False, recorder=None,
+                      logger=None, codec=None, stats=None):
+    ''' Start (or connect to) SERVER and initialize it, return an
+    AsyncJsonRpc.  Meant to be called many times concurrently to drive
+    several servers from a single process.  STATS (a stats.LatencyStats)
+    records the timing of the requests, initialize included.  '''
+
+    address = common.socket_address(server)
+    if address is not None:
+        reader, writer = await async_common.connect_tool_async(address)
+        json_rpc = async_common.AsyncJsonRpc(writer, reader, log, log_pretty,
+                                             logger)
+    else:
+        proc = await async_common.start_tool_async(
+            '{} {}'.format(server, cmdline_args))
+        json_rpc = async_common.AsyncJsonRpc(proc.stdin, proc.stdout, log,
+                                             log_pretty, logger)
+
+    json_rpc.recorder = recorder
+    json_rpc.stats = stats
+    if codec is not None:
+        json_rpc.codec = codec
+
+    r = await json_rpc.request(Initialize(initialize_params))
+    json_rpc.server_capabilities = r.get('capabilities', {})
+    await json_rpc.notify(Initialized())
+
+    return json_rpc
+
+
+async def shutdown_async(json_rpc):
+    await json_rpc.request(Shutdown())
+    await json_rpc.notify(Exit())
+    await json_rpc.close()
+
+
+def run_async(callback, cmdline_args="", initialize_params={}):
+    ''' Like run, but CALLBACK is a coroutine function receiving an
+    AsyncJsonRpc.  '''
+
+    args = parse_args()
+
+    unsupported = [option for option, value in (
+        ('--reader-thread', args.reader_thread),
+        ('--resource-report', args.resource_report),
+        ('--response-cache', args.response_cache),
+    ) if value not in (None, False)]
+    if unsupported:
+        raise ValueError('{} not supported by run_async'.format(
+            ', '.join(unsupported)))
+
+    async def main():
+        recorder = None
+        if args.record:
+            recorder = session_trace.TraceRecorder(args.record)
+
+        latency_stats = None
+        if args.latency_report:
+            latency_stats = stats.LatencyStats()
+
+        logger = common.MessageLogger.from_args(args)
+        json_rpc = await start_async(args.server, cmdline_args,
+                                     initialize_params, args.log,
+                                     args.log_pretty, recorder, logger,
+                                     common.make_codec(args.json_codec),
+                                     latency_stats)
+
+        if args.compact_results:
+            json_rpc.result_decoders = results.raw_decoders()
+
+        json_rpc.default_timeout = args.request_timeout
+
+        await callback(json_rpc)
+        await shutdown_async(json_rpc)
+
+        if logger is not None:
+            logger.close()
+
+        if recorder is not None:
+            recorder.close()
+
+        if args.latency_report:
+            write_latency_report(json_rpc.stats, args.latency_report)
+
+    asyncio.run(main())
@@ -0,0 +1,311 @@
+#
+# Send hover, definition and references requests at every identifier of a
+# file, to find the spots where the server is much slower than elsewhere
+# (macro-heavy regions, deep templates...).
+#
+# Requests are pipelined (--window) and rate-limited (--rate).  The latency
+# and result count of each request are saved with --csv and --json, and a
+# heatmap of the file is printed, where each identifier is drawn with a
+# character showing how slow the slowest request at that position was:
+#
+#   python3 position_sweep.py --file cpp-test/src/first.cpp \
+#       --method hover --method definition --rate 200 \
+#       "/path/to/clangd --compile-commands-dir ${PWD}/cpp-test/build-1"
+#
+
+import bisect
+import collections
+import csv
+import json
+import math
+import os
+import re
+import time
+
+import common
+import diagnostics
+import documents
+import ls_interact as ls
+import response_cache
+import results
+import stats
+
+METHODS = {
+    'hover': ls.Hover,
+    'definition': ls.GotoDefinition,
+    'references': ls.FindReferences,
+}
+
+# Comments and string/char literals are skipped, identifiers are captured.
+TOKEN_RE = re.compile(r'//[^\n]*|/\*.*?\*/|"(?:\\.|[^"\\\n])*"'
+                      r"|'(?:\\.|[^'\\\n])*'|([A-Za-z_]\w*)", re.S)
+
+KEYWORDS = {
+    'auto', 'bool', 'break', 'case', 'char', 'class', 'const', 'constexpr',
+    'continue', 'default', 'defer', 'define', 'delete', 'do', 'double',
+    'elif', 'else', 'endif', 'enum', 'explicit', 'extern', 'false', 'float',
+    'for', 'func', 'go', 'goto', 'if', 'ifdef', 'ifndef', 'import',
+    'include', 'inline', 'int', 'interface', 'long', 'namespace', 'new',
+    'nullptr', 'operator', 'package', 'private', 'protected', 'public',
+    'range', 'return', 'short', 'signed', 'sizeof', 'static', 'struct',
+    'switch', 'template', 'this', 'true', 'typedef', 'typename', 'union',
+    'unsigned', 'using', 'var', 'virtual', 'void', 'volatile', 'while',
+}
+
+# From fastest to slowest.
+HEAT_CHARS = '.:-=+*#%@'
+
+
+def tokenize(text):
+    ''' Return the identifiers of TEXT (skipping keywords, comments and
+    literals) as (line, character, name) tuples, 0-based, with the
+    character in UTF-16 code units.  '''
+
+    line_starts = [0] + [m.end() for m in re.finditer('\n', text)]
+    tokens = []
+
+    for m in TOKEN_RE.finditer(text):
+        name = m.group(1)
+        if name is None or name in KEYWORDS:
+            continue
+
+        line = bisect.bisect_right(line_starts, m.start()) - 1
+        segment = text[line_starts[line]:m.start()]
+        if segment.isascii():
+            character = len(segment)
+        else:
+            character = len(segment.encode('utf-16-le')) // 2
+
+        tokens.append((line, character, name))
+
+    return tokens
+
+
+def result_count(result):
+    if result is None:
+        return 0
+
+    if isinstance(result, (list, results.ColumnarList)):
+        return len(result)
+
+    return 1
+
+
+def request_id(pending):
+    ''' Return the id of the request PENDING (returned by request) waits
+    for, or None if it was answered from the response cache.  '''
+
+    if isinstance(pending, response_cache.CachedReply):
+        return None
+
+    if isinstance(pending, response_cache.CachePending):
+        pending = pending.pending
+
+    return pending.key()[1]
+
+
+def sweep(json_rpc, path, tokens, methods, window=16, rate=None):
+    ''' Send a request for each method in METHODS at each token of TOKENS
+    in the document at PATH, keeping up to WINDOW in flight and sending at
+    most RATE per second.  Return one row (a dict) per request.  '''
+
+    if json_rpc.stats is None:
+        json_rpc.stats = stats.LatencyStats()
+    # Only keep the samples of the requests sent here until their row is
+    # done.
+    by_id = json_rpc.stats.by_id = {}
+
+    period = 1.0 / rate if rate else 0
+    next_send = time.monotonic()
+    in_flight = collections.deque()
+    rows = []
+
+    def finish():
+        row, pending = in_flight.popleft()
+        the_id = request_id(pending)
+        try:
+            row['count'] = result_count(json_rpc.wait_for(pending))
+            if the_id is None:
+                # Cache hit.
+                row['ms'] = 0.0
+            else:
+                row['ms'] = by_id.pop(the_id)['total'] * 1000
+        except common.RequestTimeout:
+            row['error'] = 'timeout'
+        except Exception as e:
+            row['error'] = str(e)
+
+        rows.append(row)
+
+    for line, character, name in tokens:
+        for method in methods:
+            if len(in_flight) >= window:
+                finish()
+
+            # Pump instead of sleeping, so replies are timed as they arrive.
+            now = time.monotonic()
+            while now < next_send:
+                json_rpc.pump(next_send - now)
+                now = time.monotonic()
+            next_send = max(next_send, now) + period
+
+            req = METHODS[method](path, line + 1, character + 1)
+            row = {
+                'line': line + 1,
+                'column': character + 1,
+                'token': name,
+                'method': method,
+                'ms': None,
+                'count': None,
+                'error': None,
+            }
+            in_flight.append((row, json_rpc.request(req)))
+
+    while in_flight:
+        finish()
+
+    json_rpc.stats.by_id = None
+
+    return rows
+
+
+def format_heatmap(text, rows):
+    ''' Return TEXT with, under each line, each token drawn with a
+    character showing the latency of the slowest request at its position
+    (log scale, from HEAT_CHARS[0] to HEAT_CHARS[-1]; 'X' for errors).  '''
+
+    slowest = {}
+    for row in rows:
+        key = (row['line'], row['column'], row['token'])
+        ms = float('inf') if row['error'] else row['ms']
+        slowest[key] = max(slowest.get(key, 0), ms)
+
+    finite = [ms for ms in slowest.values() if ms != float('inf')]
+    low = max(min(finite, default=1), 0.01)
+    high = max(max(finite, default=1), low * 1.01)
+    scale = (len(HEAT_CHARS) - 1) / (math.log10(high) - math.log10(low))
+
+    by_line = collections.defaultdict(list)
+    for (line, column, token), ms in slowest.items():
+        by_line[line].append((column, token, ms))
+
+    lines = ['heat: {} = {:.2f} ms ... {} = {:.2f} ms, X = error'.format(
+        HEAT_CHARS[0], low, HEAT_CHARS[-1], high)]
+
+    for number, source in enumerate(text.split('\n'), 1):
+        source = source.expandtabs(1)
+        tokens = by_line.get(number)
+        if not tokens:
+            lines.append('{:6}          | {}'.format(number, source))
+            continue
+
+        overlay = [' '] * len(source)
+        for column, token, ms in tokens:
+            if ms == float('inf'):
+                char = 'X'
+            else:
+                level = round((math.log10(max(ms, low))
+                               - math.log10(low)) * scale)
+                char = HEAT_CHARS[level]
+            # UTF-16 columns, close enough for drawing.
+            for i in range(column - 1, min(column - 1 + len(token),
+                                           len(overlay))):
+                overlay[i] = char
+
+        worst = max(ms for _, _, ms in tokens)
+        lines.append('{:6} {:>8} | {}'.format(
+            number, 'error' if worst == float('inf')
+            else '{:.1f}'.format(worst), source))
+        lines.append('{:6} {:8} | {}'.format('', '', ''.join(overlay)))
+
+    return '\n'.join(lines)
+
+
+def format_slowest(rows, count=10):
+    rows = sorted((row for row in rows if row['ms'] is not None),
+                  key=lambda row: row['ms'], reverse=True)[:count]
+
+    lines = ['slowest:']
+    for row in rows:
+        lines.append('  {:9.2f} ms  {:10}  {}:{}  {}'.format(
+            row['ms'], row['method'], row['line'], row['column'],
+            row['token']))
+
+    return '\n'.join(lines)
+
+
+def write_csv(rows, path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['line', 'column', 'token',
+                                               'method', 'ms', 'count',
+                                               'error'])
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def interact(json_rpc, args):
+    path = os.path.abspath(args.file)
+    with open(path) as f:
+        text = f.read()
+
+    diags = diagnostics.DiagnosticsStore(json_rpc)
+    docs = documents.DocumentStore(json_rpc, diags)
+    docs.open(path, text)
+
+    # Let the server parse the file first, so the first requests don't pay
+    # for it.
+    try:
+        diags.wait_for_diagnostics([path], args.settle_timeout)
+    except TimeoutError:
+        print('warning: no diagnostics for {}, sweeping anyway'.format(path))
+
+    tokens = tokenize(text)
+    methods = args.method or list(METHODS)
+    print('{} identifiers, {} requests'.format(len(tokens),
+                                               len(tokens) * len(methods)))
+
+    start = time.monotonic()
+    rows = sweep(json_rpc, path, tokens, methods, args.window, args.rate)
+    print('swept in {:.3f} s'.format(time.monotonic() - start))
+
+    if not args.no_heatmap:
+        print(format_heatmap(text, rows))
+    print(format_slowest(rows))
+
+    if args.csv:
+        write_csv(rows, args.csv)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=4)
+
+
+def args_cb(argparser):
+    argparser.add_argument('--file', required=True,
+                           help='file to sweep')
+    argparser.add_argument('--method', action='append',
+                           choices=list(METHODS),
+                           help='request to send at each identifier (may be '
+                                'repeated, default: all)')
+    argparser.add_argument('--window', type=int, default=16,
+                           help='requests in flight (default: %(default)s)')
+    argparser.add_argument('--rate', type=float,
+                           help='maximum requests per second')
+    argparser.add_argument('--settle-timeout', metavar='SECONDS', type=float,
+                           default=60,
+                           help=('wait this long for the diagnostics of the '
+                                 'file before sweeping'))
+    argparser.add_argument('--csv', metavar='FILE',
+                           help='save the per-position results as CSV')
+    argparser.add_argument('--json', metavar='FILE',
+                           help='save the per-position results as JSON')
+    argparser.add_argument('--no-heatmap', action='store_true',
+                           help="don't print the heatmap")
+
+
+def main():
+    ls.run(interact, args_cb=args_cb)
+
+
+if __name__ == '__main__':
+    main()
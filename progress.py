@@ -0,0 +1,123 @@
+import threading
+import time
+
+
+class ProgressTracker:
+    ''' Follow the work done progress ($/progress notifications) reported by
+    the server, for example clangd's background indexing.
+
+    It answers window/workDoneProgress/create requests, so the server can
+    start reporting (the client must also set the window.workDoneProgress
+    capability in initialize).  Like DiagnosticsStore, it consumes the
+    $/progress notifications unless CONSUME is false.  '''
+
+    def __init__(self, json_rpc, consume=True):
+        self._json_rpc = json_rpc
+        self._consume = consume
+        self._lock = threading.Lock()
+        # token -> entry, in creation order.
+        self._tokens = {}
+        # Time of the last create or $/progress received.
+        self.last_activity = None
+
+        json_rpc.on_request('window/workDoneProgress/create', self._on_create)
+        json_rpc.on_notification('$/progress', self._on_progress)
+
+    def _entry(self, token, now):
+        entry = self._tokens.get(token)
+        if entry is None:
+            entry = {
+                'token': token,
+                'title': None,
+                'created': now,
+                'begin': None,
+                'end': None,
+                'reports': 0,
+            }
+            self._tokens[token] = entry
+
+        return entry
+
+    def _on_create(self, params):
+        now = time.monotonic()
+        with self._lock:
+            self._entry(str(params['token']), now)
+            self.last_activity = now
+
+        return None
+
+    def _on_progress(self, json_data):
+        now = time.monotonic()
+        params = json_data['params']
+        value = params.get('value')
+        if not isinstance(value, dict):
+            # Partial results (see JsonRpc.stream), not work done progress.
+            return False
+
+        kind = value.get('kind')
+
+        with self._lock:
+            entry = self._entry(str(params['token']), now)
+            if kind == 'begin':
+                entry['begin'] = now
+                entry['title'] = value.get('title')
+            elif kind == 'end':
+                entry['end'] = now
+            else:
+                entry['reports'] += 1
+            self.last_activity = now
+
+        return self._consume
+
+    def active(self):
+        ''' Return the tokens that began (or were created) and didn't end
+        yet.  '''
+
+        with self._lock:
+            return [token for token, entry in self._tokens.items()
+                    if entry['end'] is None
+                    and (entry['begin'] is not None or entry['reports'] == 0)]
+
+    def wait_until_idle(self, quiet=1.0, timeout=None):
+        ''' Wait until no progress is active and nothing was reported for
+        QUIET seconds (servers often chain several tasks), and return the
+        time the last one ended, or None if none ever did.  Raise
+        TimeoutError after TIMEOUT seconds.  '''
+
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+
+        while True:
+            now = time.monotonic()
+            if not self.active():
+                last = self.last_activity
+                if last is None:
+                    last = start
+                if now - last >= quiet:
+                    break
+                wait = quiet - (now - last)
+            else:
+                wait = quiet
+
+            if deadline is not None:
+                if now >= deadline:
+                    raise TimeoutError(
+                        'work done progress still active: {}'.format(
+                            ', '.join(self.active())))
+                wait = min(wait, deadline - now)
+
+            self._json_rpc.pump(wait)
+
+        with self._lock:
+            ends = [entry['end'] for entry in self._tokens.values()
+                    if entry['end'] is not None]
+
+        return max(ends, default=None)
+
+    def timings(self):
+        ''' Return one entry per token: its title and the times it was
+        created, began and ended (time.monotonic, None if it didn't), and
+        the number of reports.  '''
+
+        with self._lock:
+            return [dict(entry) for entry in self._tokens.values()]
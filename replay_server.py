@@ -0,0 +1,145 @@
+#
+# Stub server replaying the server side of a trace recorded with --record.
+#
+# Record a session:
+#   python3 test_clangd.py --record session.trace.gz "/path/to/clangd ..."
+# Replay it, without clangd:
+#   python3 test_clangd.py "python3 replay_server.py session.trace.gz"
+#
+# Server messages are sent once the client messages that preceded them in
+# the trace have been received, after the same delay as in the original
+# session (divided by --speed, --speed 0 sends them right away).  Request
+# ids in the replayed responses are rewritten to the ids the client used.
+#
+
+import argparse
+import json
+import socket
+import sys
+import time
+
+import common
+import session_trace
+
+
+class ReplayServer:
+    def __init__(self, records, speed, inp, output):
+        self._records = records
+        self._speed = speed
+        self._input = inp
+        self._output = output
+        self._framer = common.MessageFramer()
+        # Client messages received so far, and when each arrived.
+        self._received = []
+        self._received_times = []
+        # Recorded request id -> id used by the live client.
+        self._id_map = {}
+        self._recorded_client = [msg for _, d, msg in records if d == 'c']
+
+    def _receive_one(self):
+        body = self._framer.next_body()
+
+        while body is None:
+            chunk = common.read_chunk(self._input, self._framer.READ_SIZE)
+            if not chunk:
+                raise EOFError('client closed the connection')
+
+            self._framer.feed(chunk)
+            body = self._framer.next_body()
+
+        msg = json.loads(body.decode(self._framer.last_charset))
+        index = len(self._received)
+        self._received.append(msg)
+        self._received_times.append(time.monotonic())
+
+        if index < len(self._recorded_client):
+            recorded = self._recorded_client[index]
+            for key in ('id', 'seq'):
+                if key in recorded and key in msg:
+                    self._id_map[str(recorded[key])] = msg[key]
+
+    def _rewrite_ids(self, msg):
+        if 'method' not in msg and 'id' in msg:
+            msg['id'] = self._id_map.get(str(msg['id']), msg['id'])
+
+        if msg.get('type') == 'response' and 'request_seq' in msg:
+            msg['request_seq'] = self._id_map.get(str(msg['request_seq']),
+                                                  msg['request_seq'])
+
+        return msg
+
+    def _send(self, msg):
+        b = json.dumps(msg).encode()
+        header = 'Content-Length: {}\r\n\r\n'.format(len(b)).encode()
+        self._output.write(header + b)
+        self._output.flush()
+
+    def run(self):
+        start = time.monotonic()
+        # Number of client messages recorded before the current record, and
+        # the (recorded) time of the last one.
+        client_count = 0
+        anchor_time = 0.0
+
+        for t, direction, msg in self._records:
+            if direction == 'c':
+                client_count += 1
+                anchor_time = t
+                continue
+
+            while len(self._received) < client_count:
+                self._receive_one()
+
+            if self._speed > 0:
+                if client_count > 0:
+                    live_anchor = self._received_times[client_count - 1]
+                else:
+                    live_anchor = start
+
+                due = live_anchor + (t - anchor_time) / self._speed
+                delay = due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+            self._send(self._rewrite_ids(msg))
+
+        # Nothing left to say, wait for the client to go away.
+        try:
+            while True:
+                self._receive_one()
+        except EOFError:
+            pass
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('trace', help='trace file recorded with --record')
+    argparser.add_argument('--speed', type=float, default=1.0,
+                           help=('speed factor applied to the recorded '
+                                 'delays, 0 to send as fast as possible'))
+    argparser.add_argument('--port', type=int,
+                           help='listen on this TCP port instead of stdio')
+    args = argparser.parse_args()
+
+    records = session_trace.read_trace(args.trace)
+
+    if args.port is not None:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(('127.0.0.1', args.port))
+        listener.listen(1)
+        conn, _ = listener.accept()
+        f = conn.makefile(mode='rwb')
+        server = ReplayServer(records, args.speed, f, f)
+    else:
+        server = ReplayServer(records, args.speed, sys.stdin.buffer,
+                              sys.stdout.buffer)
+
+    try:
+        server.run()
+    except (EOFError, BrokenPipeError):
+        pass
+
+
+if __name__ == '__main__':
+    main()
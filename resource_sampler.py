@@ -0,0 +1,180 @@
+import json
+import os
+import threading
+import time
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+def _children(pid):
+    ''' Return the pids of the direct children of PID.  '''
+
+    children = []
+    try:
+        for tid in os.listdir('/proc/{}/task'.format(pid)):
+            with open('/proc/{}/task/{}/children'.format(pid, tid)) as f:
+                children += [int(c) for c in f.read().split()]
+    except OSError:
+        pass
+
+    return children
+
+
+def process_tree(pid):
+    ''' Return PID and the pids of all its descendants.  '''
+
+    pids = [pid]
+    i = 0
+    while i < len(pids):
+        pids += _children(pids[i])
+        i += 1
+
+    return pids
+
+
+def read_process(pid):
+    ''' Return a dict with the RSS (bytes), CPU time (seconds), thread count
+    and I/O bytes of process PID, or None if it's gone.  '''
+
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            # The command name may contain spaces, skip past it.
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open('/proc/{}/statm'.format(pid)) as f:
+            rss_pages = int(f.read().split()[1])
+    except OSError:
+        return None
+
+    io = {}
+    try:
+        with open('/proc/{}/io'.format(pid)) as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                io[name] = int(value)
+    except OSError:
+        # Not allowed to read it, report zeros.
+        pass
+
+    # fields[0] is field 3 of stat (state).
+    return {
+        'rss': rss_pages * PAGE_SIZE,
+        'cpu': (int(fields[11]) + int(fields[12])) / CLOCK_TICKS,
+        'threads': int(fields[17]),
+        'read_bytes': io.get('read_bytes', 0),
+        'write_bytes': io.get('write_bytes', 0),
+    }
+
+
+class ResourceSampler:
+    ''' Sample the resource usage of a server process and its descendants
+    (start_tool runs the server through a shell), every INTERVAL seconds,
+    in a background thread.
+
+    Sample times are relative to "start" in the summary, a time.monotonic()
+    value.  The message log file, the trace header and the latency report
+    all use time.monotonic(), so they can be lined up with the samples.
+    mark() adds a labelled event to the timeline.  '''
+
+    def __init__(self, pid, interval=0.1):
+        self._pid = pid
+        self._interval = interval
+        self._samples = []
+        self._marks = []
+        self._stop = threading.Event()
+        self.start_time = time.monotonic()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def mark(self, label):
+        self._marks.append((time.monotonic(), label))
+
+    def sample(self):
+        total = {'rss': 0, 'cpu': 0.0, 'threads': 0, 'read_bytes': 0,
+                 'write_bytes': 0}
+        pids = process_tree(self._pid)
+
+        for pid in pids:
+            info = read_process(pid)
+            if info is not None:
+                for name in total:
+                    total[name] += info[name]
+
+        total['time'] = time.monotonic()
+        total['processes'] = len(pids)
+        self._samples.append(total)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self.sample()
+            self._stop.wait(self._interval)
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def summary(self):
+        ''' Return a JSON-serializable dict with all the samples and marks.
+        Times are in seconds since the sampler started.  '''
+
+        def rel(t):
+            return round(t - self.start_time, 6)
+
+        samples = []
+        for s in self._samples:
+            s = dict(s)
+            s['time'] = rel(s['time'])
+            samples.append(s)
+
+        return {
+            'clock': 'monotonic',
+            'start': self.start_time,
+            'interval': self._interval,
+            'peak_rss': max((s['rss'] for s in samples), default=0),
+            'samples': samples,
+            'marks': [{'time': rel(t), 'label': label}
+                      for t, label in self._marks],
+        }
+
+    def to_json(self):
+        return json.dumps(self.summary(), indent=4)
+
+    def format_timeline(self, max_rows=40):
+        ''' Return the timeline as a table, with at most MAX_ROWS samples
+        (evenly picked) and the marks in between.  '''
+
+        samples = self._samples
+        step = max(len(samples) // max_rows, 1)
+        rows = samples[::step]
+        if samples and rows[-1] is not samples[-1]:
+            rows.append(samples[-1])
+
+        lines = ['{:>9}  {:>9}  {:>6}  {:>7}  {:>9}  {:>9}'.format(
+            'time s', 'RSS MB', 'CPU %', 'threads', 'read MB', 'write MB')]
+        marks = list(self._marks)
+        prev = None
+
+        for s in rows:
+            while marks and marks[0][0] <= s['time']:
+                t, label = marks.pop(0)
+                lines.append('{:9.3f}  -- {}'.format(t - self.start_time,
+                                                     label))
+
+            cpu = 0.0
+            if prev is not None and s['time'] > prev['time']:
+                cpu = (100 * (s['cpu'] - prev['cpu'])
+                       / (s['time'] - prev['time']))
+            prev = s
+
+            lines.append('{:9.3f}  {:9.1f}  {:6.1f}  {:7}  {:9.1f}  {:9.1f}'
+                         .format(s['time'] - self.start_time, s['rss'] / 1e6,
+                                 cpu, s['threads'], s['read_bytes'] / 1e6,
+                                 s['write_bytes'] / 1e6))
+
+        for t, label in marks:
+            lines.append('{:9.3f}  -- {}'.format(t - self.start_time, label))
+
+        peak = max((s['rss'] for s in samples), default=0)
+        lines.append('peak RSS: {:.1f} MB'.format(peak / 1e6))
+
+        return '\n'.join(lines)
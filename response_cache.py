@@ -0,0 +1,238 @@
+#
+# Client-side cache of the replies to idempotent requests (hover,
+# definition, references), keyed by method, document, document version and
+# position.
+#
+# A ResponseCache wraps a JsonRpc and can be used in its place: requests
+# that hit the cache are not sent to the server.  The document notifications
+# must go through it (e.g. give it to the DocumentStore), so it knows the
+# version of each document and forgets the replies about a document when it
+# is changed or closed:
+#
+#   cache = response_cache.ResponseCache(json_rpc, max_bytes=16 << 20)
+#   docs = documents.DocumentStore(cache)
+#   docs.open(path)
+#   r = cache.wait_for(cache.request(ls.Hover(path, 10, 5)))
+#
+# ls_interact's --response-cache option does this for the callback.
+#
+
+import collections
+import threading
+
+import common
+import ls_interact as ls
+
+
+class CachedReply:
+    ''' Returned by ResponseCache.request on a hit.  '''
+
+    def __init__(self, result):
+        self.result = result
+
+
+class CachePending:
+    ''' Returned by ResponseCache.request on a miss.  '''
+
+    def __init__(self, key, generation):
+        self.key = key
+        self.generation = generation
+        self.pending = None
+        # Size of the reply body, set when it's received.
+        self.size = None
+
+
+class ResponseCache:
+    # Requests whose reply only depends on the document and the position.
+    CACHEABLE = {
+        'textDocument/hover',
+        'textDocument/definition',
+        'textDocument/references',
+    }
+
+    def __init__(self, json_rpc, max_bytes=64 << 20):
+        self._json_rpc = json_rpc
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # key -> (result, size), least recently used first.
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        # path -> keys of the entries about that document.
+        self._by_path = collections.defaultdict(set)
+        # path -> version of the document, from the notifications sent.
+        self._versions = {}
+        # path -> number of invalidations, so replies to requests sent
+        # before an invalidation are not cached.
+        self._generations = collections.Counter()
+        # method -> [hits, misses]
+        self._counts = collections.defaultdict(lambda: [0, 0])
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __getattr__(self, name):
+        # Everything else is the JsonRpc's business.
+        return getattr(self._json_rpc, name)
+
+    @property
+    def stats(self):
+        return self._json_rpc.stats
+
+    @stats.setter
+    def stats(self, latency_stats):
+        # Replies are timed by the JsonRpc.
+        self._json_rpc.stats = latency_stats
+
+    def _key(self, req):
+        method_name = req.get_method_name()
+        if (method_name not in self.CACHEABLE
+                or not isinstance(req, ls.TextDocumentBase)):
+            return None
+
+        path = req.get_path()
+        position = req.get_params().get('position') or {}
+        return (method_name, path, self._versions.get(path),
+                position.get('line'), position.get('character'))
+
+    def _invalidate(self, path):
+        with self._lock:
+            self._generations[path] += 1
+            for key in self._by_path.pop(path, ()):
+                _, size = self._entries.pop(key)
+                self._bytes -= size
+                self.invalidations += 1
+
+    def notify(self, notif):
+        if isinstance(notif, (ls.DidOpenTextDocument,
+                              ls.DidChangeTextDocument,
+                              ls.DidCloseTextDocument)):
+            path = notif.get_path()
+            self._invalidate(path)
+
+            if isinstance(notif, ls.DidCloseTextDocument):
+                self._versions.pop(path, None)
+            else:
+                self._versions[path] = notif.get_version()
+
+        return self._json_rpc.notify(notif)
+
+    def request(self, req, timeout=None):
+        ''' Return a CachedReply if the reply to REQ is cached, otherwise
+        send it.  Either way, pass the returned object to wait_for.  '''
+
+        key = self._key(req)
+        if key is None:
+            return self._json_rpc.request(req, timeout)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            counts = self._counts[key[0]]
+            if entry is not None:
+                self._entries.move_to_end(key)
+                counts[0] += 1
+                return CachedReply(entry[0])
+
+            counts[1] += 1
+            generation = self._generations[key[1]]
+
+        pending = CachePending(key, generation)
+        default = self._json_rpc.result_decoders.get(key[0])
+
+        def decoder(body, codec, charset):
+            pending.size = len(body)
+            if default is not None:
+                return default(body, codec, charset)
+            return codec.loads(body, charset)
+
+        pending.pending = self._json_rpc.request(req, timeout, decoder)
+        return pending
+
+    def _store(self, pending, result):
+        key, generation = pending.key, pending.generation
+        if hasattr(result, 'nbytes'):
+            # A compact list (see results.raw_decoder).
+            size = result.nbytes()
+        elif pending.size is not None:
+            # The size of the reply is what we keep in memory, roughly.
+            size = pending.size
+        else:
+            size = len(self._json_rpc.codec.dumps(result))
+        if size > self._max_bytes:
+            return
+
+        with self._lock:
+            if (self._generations[key[1]] != generation
+                    or key in self._entries):
+                return
+
+            self._entries[key] = (result, size)
+            self._by_path[key[1]].add(key)
+            self._bytes += size
+
+            while self._bytes > self._max_bytes:
+                old_key, (_, old_size) = self._entries.popitem(last=False)
+                self._by_path[old_key[1]].discard(old_key)
+                self._bytes -= old_size
+                self.evictions += 1
+
+    def wait_for(self, pending):
+        if isinstance(pending, CachedReply):
+            return pending.result
+
+        if isinstance(pending, CachePending):
+            result = self._json_rpc.wait_for(pending.pending)
+            self._store(pending, result)
+            return result
+
+        return self._json_rpc.wait_for(pending)
+
+    def gather(self, pendings):
+        ''' Like JsonRpc.gather, for objects returned by request.  '''
+
+        return [self.wait_for(p) for p in pendings]
+
+    def request_many(self, reqs, window=None, timeout=None):
+        ''' Like JsonRpc.request_many: keep up to WINDOW requests in flight
+        (cache hits included) and return their results in order.  '''
+
+        return common.request_window(
+            reqs, lambda batch: [self.request(req, timeout) for req in batch],
+            self.wait_for, window)
+
+    def summary(self):
+        ''' Return a JSON-serializable dict with the hits and misses per
+        method and the cache occupancy.  '''
+
+        with self._lock:
+            methods = {}
+            for method_name, (hits, misses) in sorted(self._counts.items()):
+                methods[method_name] = {
+                    'hits': hits,
+                    'misses': misses,
+                    'hit_rate': hits / (hits + misses),
+                }
+
+            return {
+                'methods': methods,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self._max_bytes,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+    def format_stats(self):
+        summary = self.summary()
+        lines = ['{:28}  {:>8}  {:>8}  {:>8}'.format(
+            'method', 'hits', 'misses', 'hit rate')]
+
+        for method_name, s in summary['methods'].items():
+            lines.append('{:28}  {:8}  {:8}  {:7.1f}%'.format(
+                method_name, s['hits'], s['misses'], 100 * s['hit_rate']))
+
+        lines.append('{} entries, {:.1f} of {:.1f} MB, {} evicted, '
+                     '{} invalidated'.format(
+                         summary['entries'], summary['bytes'] / 1e6,
+                         summary['max_bytes'] / 1e6, summary['evictions'],
+                         summary['invalidations']))
+
+        return '\n'.join(lines)
@@ -0,0 +1,514 @@
+#
+# Compact model of the results of location-heavy requests.
+#
+# A references reply with hundreds of thousands of locations, decoded as
+# nested dicts, costs hundreds of MB.  The lists below keep the same data in
+# columns instead: the ranges in an int array, the URIs interned once in a
+# table.  Range/Location/... objects are only created for the items actually
+# looked at, so len(), count_by_uri() or filter_uri() never materialize
+# them:
+#
+#   r = results.decode('textDocument/references', json_rpc.wait_for(p))
+#   print(len(r), r.count_by_uri())
+#   for loc in r.filter_uri(lambda uri: uri.endswith('/bar.cpp')):
+#       print(loc.range.start_line)
+#
+# The replies can also be decoded straight into these lists, without
+# building the dicts first, by giving the request a decoder (or with
+# ls_interact's --compact-results):
+#
+#   decoder = results.raw_decoder('textDocument/references')
+#   p = json_rpc.request(ls.FindReferences(path, 10, 5), decoder=decoder)
+#   r = json_rpc.wait_for(p)
+#
+# Run bench_results.py to compare their memory usage with plain dicts.
+#
+
+import collections
+import collections.abc
+import json
+import re
+import sys
+from array import array
+
+# Patterns to build a LocationList straight from the raw JSON of a reply
+# (see raw_decoder), for the key orders of any JSON library.
+_RAW_STRING = rb'"([^"\\]*(?:\\.[^"\\]*)*)"'
+_RAW_POSITION = (rb'\{\s*"(line|character)"\s*:\s*(\d+)\s*,'
+                 rb'\s*"(?:line|character)"\s*:\s*(\d+)\s*\}')
+_RAW_RANGE = (rb'\{\s*"(start|end)"\s*:\s*' + _RAW_POSITION
+              + rb'\s*,\s*"(?:start|end)"\s*:\s*' + _RAW_POSITION + rb'\s*\}')
+# Groups: URI, range (7 groups) when the URI comes first, range and URI
+# otherwise, then the ',' if another location follows.
+_RAW_LOCATION_RE = re.compile(
+    rb'\s*\{\s*(?:"uri"\s*:\s*' + _RAW_STRING + rb'\s*,\s*"range"\s*:\s*'
+    + _RAW_RANGE + rb'|"range"\s*:\s*' + _RAW_RANGE + rb'\s*,\s*"uri"\s*:\s*'
+    + _RAW_STRING + rb')\s*\}\s*(?:(,)|\])')
+_RAW_EMPTY_RE = re.compile(rb'\s*\]')
+_RAW_RESULT_RE = re.compile(rb'"result"\s*:\s*\[')
+
+
+class Range:
+    ''' An LSP range (0-based lines and characters).  '''
+
+    __slots__ = ('start_line', 'start_character', 'end_line',
+                 'end_character')
+
+    def __init__(self, start_line, start_character, end_line,
+                 end_character):
+        self.start_line = start_line
+        self.start_character = start_character
+        self.end_line = end_line
+        self.end_character = end_character
+
+    @classmethod
+    def from_lsp(cls, obj):
+        start = obj['start']
+        end = obj['end']
+        return cls(start['line'], start['character'], end['line'],
+                   end['character'])
+
+    def to_lsp(self):
+        return {
+            'start': {'line': self.start_line,
+                      'character': self.start_character},
+            'end': {'line': self.end_line, 'character': self.end_character},
+        }
+
+    def __eq__(self, other):
+        return (isinstance(other, Range)
+                and self._tuple() == other._tuple())
+
+    def _tuple(self):
+        return (self.start_line, self.start_character, self.end_line,
+                self.end_character)
+
+    def __repr__(self):
+        return 'Range({}:{}-{}:{})'.format(
+            self.start_line, self.start_character, self.end_line,
+            self.end_character)
+
+
+class Location:
+    __slots__ = ('uri', 'range')
+
+    def __init__(self, uri, range_):
+        self.uri = uri
+        self.range = range_
+
+    @classmethod
+    def from_lsp(cls, obj):
+        return cls(obj['uri'], Range.from_lsp(obj['range']))
+
+    def to_lsp(self):
+        return {'uri': self.uri, 'range': self.range.to_lsp()}
+
+    def __eq__(self, other):
+        return (isinstance(other, Location) and self.uri == other.uri
+                and self.range == other.range)
+
+    def __repr__(self):
+        return 'Location({}, {})'.format(self.uri, self.range)
+
+
+class Diagnostic:
+    ''' A diagnostic.  EXTRA holds the fields we don't model (tags,
+    relatedInformation, ...), or None.  '''
+
+    __slots__ = ('range', 'severity', 'code', 'source', 'message', 'extra')
+
+    def __init__(self, range_, message, severity=None, code=None,
+                 source=None, extra=None):
+        self.range = range_
+        self.message = message
+        self.severity = severity
+        self.code = code
+        self.source = source
+        self.extra = extra
+
+    def to_lsp(self):
+        obj = {'range': self.range.to_lsp(), 'message': self.message}
+        for name, value in (('severity', self.severity), ('code', self.code),
+                            ('source', self.source)):
+            if value is not None:
+                obj[name] = value
+        if self.extra:
+            obj.update(self.extra)
+
+        return obj
+
+    def __repr__(self):
+        return 'Diagnostic({}, {!r})'.format(self.range, self.message)
+
+
+class SymbolInformation:
+    __slots__ = ('name', 'kind', 'location', 'container_name')
+
+    def __init__(self, name, kind, location, container_name=None):
+        self.name = name
+        self.kind = kind
+        self.location = location
+        self.container_name = container_name
+
+    def to_lsp(self):
+        obj = {
+            'name': self.name,
+            'kind': self.kind,
+            'location': self.location.to_lsp(),
+        }
+        if self.container_name is not None:
+            obj['containerName'] = self.container_name
+
+        return obj
+
+    def __repr__(self):
+        return 'SymbolInformation({!r}, {}, {})'.format(
+            self.name, self.kind, self.location)
+
+
+class ColumnarList(collections.abc.Sequence):
+    ''' Base of the compact lists: items are stored in parallel columns
+    (arrays or lists, named in COLUMNS) plus an int array holding 4 values
+    per item for its range.  Items are built on access by _item.  '''
+
+    COLUMNS = ()
+
+    def __init__(self):
+        self._ranges = array('i')
+        for name in self.COLUMNS:
+            setattr(self, name, self._new_column(name))
+
+    def _new_column(self, name):
+        raise NotImplementedError
+
+    def _add_range(self, obj):
+        start = obj['start']
+        end = obj['end']
+        self._ranges.extend((start['line'], start['character'], end['line'],
+                             end['character']))
+
+    def _range(self, i):
+        return Range(*self._ranges[4 * i:4 * i + 4])
+
+    def __len__(self):
+        return len(self._ranges) // 4
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._select(range(*index.indices(len(self))))
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('index out of range')
+
+        return self._item(index)
+
+    def _item(self, i):
+        raise NotImplementedError
+
+    def _select(self, indexes):
+        ''' Return a list of the same kind with the items at INDEXES.  '''
+
+        new = self.__class__.__new__(self.__class__)
+        new.__dict__.update(self.__dict__)
+        new._ranges = array('i')
+        for name in self.COLUMNS:
+            setattr(new, name, self._new_column(name))
+
+        columns = [(getattr(self, name), getattr(new, name))
+                   for name in self.COLUMNS]
+        for i in indexes:
+            new._ranges.extend(self._ranges[4 * i:4 * i + 4])
+            for old_column, new_column in columns:
+                new_column.append(old_column[i])
+
+        return new
+
+    def to_lsp(self):
+        return [item.to_lsp() for item in self]
+
+    def nbytes(self):
+        ''' Approximate memory used by the columns (not counting the
+        strings).  '''
+
+        total = sys.getsizeof(self._ranges)
+        for name in self.COLUMNS:
+            total += sys.getsizeof(getattr(self, name))
+
+        return total
+
+
+class UriColumnList(ColumnarList):
+    ''' A ColumnarList whose items have a URI, stored as an index in a table
+    of interned URIs.  '''
+
+    COLUMNS = ('_uri_index',)
+
+    def __init__(self):
+        super().__init__()
+        self._uri_table = []
+        self._uri_ids = {}
+
+    def _uri_id(self, uri):
+        uri_id = self._uri_ids.get(uri)
+        if uri_id is None:
+            uri_id = len(self._uri_table)
+            self._uri_table.append(sys.intern(uri))
+            self._uri_ids[uri] = uri_id
+
+        return uri_id
+
+    def _new_column(self, name):
+        # Indexes in _uri_table.
+        return array('I')
+
+    def uris(self):
+        ''' Return the distinct URIs, in order of first appearance.  '''
+
+        return [self._uri_table[uri_id]
+                for uri_id in dict.fromkeys(self._uri_index)]
+
+    def count_by_uri(self):
+        ''' Return a dict URI -> number of items.  '''
+
+        counts = collections.Counter(self._uri_index)
+        return {self._uri_table[uri_id]: count
+                for uri_id, count in counts.items()}
+
+    def filter_uri(self, uri):
+        ''' Return the items whose URI is URI, or for which URI(uri) is true
+        if it's a function (called once per distinct URI).  '''
+
+        if callable(uri):
+            wanted = {i for i, u in enumerate(self._uri_table) if uri(u)}
+        else:
+            wanted = {self._uri_ids[uri]} if uri in self._uri_ids else set()
+
+        return self._select(i for i, uri_id in enumerate(self._uri_index)
+                            if uri_id in wanted)
+
+
+class LocationList(UriColumnList):
+
+    @classmethod
+    def from_lsp(cls, locations):
+        ''' Build a LocationList from a list of Location or LocationLink
+        (their target selection range is used) objects.  '''
+
+        self = cls()
+        for loc in locations or ():
+            if 'targetUri' in loc:
+                self._uri_index.append(self._uri_id(loc['targetUri']))
+                self._add_range(loc['targetSelectionRange'])
+            else:
+                self._uri_index.append(self._uri_id(loc['uri']))
+                self._add_range(loc['range'])
+
+        return self
+
+    @classmethod
+    def from_raw(cls, body, pos):
+        ''' Build a LocationList from the JSON array of Location objects
+        starting right after the '[' at POS in BODY (UTF-8 bytes), without
+        decoding it to dicts.  Return it with the position after the ']', or
+        None if the array has anything but plain Location objects.  '''
+
+        self = cls()
+        m = _RAW_EMPTY_RE.match(body, pos)
+        if m is not None:
+            return self, m.end()
+
+        # Raw URI -> its index in _uri_table.
+        raw_ids = {}
+        uri_index = self._uri_index
+        ranges = self._ranges
+
+        for m in _RAW_LOCATION_RE.finditer(body, pos):
+            if m.start() != pos:
+                return None
+
+            g = m.groups()
+            if g[0] is not None:
+                raw_uri, range_ = g[0], g[1:8]
+            else:
+                raw_uri, range_ = g[15], g[8:15]
+
+            uri_id = raw_ids.get(raw_uri)
+            if uri_id is None:
+                uri = bytes(raw_uri).decode()
+                if '\\' in uri:
+                    uri = json.loads('"' + uri + '"')
+                uri_id = raw_ids[raw_uri] = self._uri_id(uri)
+            uri_index.append(uri_id)
+
+            which, k1, a1, b1, k2, a2, b2 = range_
+            if k1 != b'line':
+                a1, b1 = b1, a1
+            if k2 != b'line':
+                a2, b2 = b2, a2
+            if which == b'start':
+                ranges.extend((int(a1), int(b1), int(a2), int(b2)))
+            else:
+                ranges.extend((int(a2), int(b2), int(a1), int(b1)))
+
+            pos = m.end()
+            if g[16] is None:
+                # That was the ']'.
+                return self, pos
+
+        return None
+
+    def _item(self, i):
+        return Location(self._uri_table[self._uri_index[i]], self._range(i))
+
+
+class SymbolList(UriColumnList):
+    COLUMNS = UriColumnList.COLUMNS + ('_kinds', '_names', '_containers')
+
+    def _new_column(self, name):
+        if name == '_kinds':
+            return array('B')
+        if name == '_uri_index':
+            return super()._new_column(name)
+        return []
+
+    @classmethod
+    def from_lsp(cls, symbols):
+        ''' Build a SymbolList from a workspace/symbol result.  Symbols
+        without a range (WorkspaceSymbol) get an empty one.  '''
+
+        self = cls()
+        empty = {'start': {'line': 0, 'character': 0},
+                 'end': {'line': 0, 'character': 0}}
+        intern = sys.intern
+
+        for sym in symbols or ():
+            location = sym['location']
+            self._uri_index.append(self._uri_id(location['uri']))
+            self._add_range(location.get('range', empty))
+            self._kinds.append(sym['kind'])
+            self._names.append(intern(sym['name']))
+            container = sym.get('containerName')
+            self._containers.append(None if container is None
+                                    else intern(container))
+
+        return self
+
+    def _item(self, i):
+        location = Location(self._uri_table[self._uri_index[i]],
+                            self._range(i))
+        return SymbolInformation(self._names[i], self._kinds[i], location,
+                                 self._containers[i])
+
+    def names(self):
+        return list(self._names)
+
+
+class DiagnosticList(ColumnarList):
+    ''' The diagnostics of one publishDiagnostics.  '''
+
+    COLUMNS = ('_severities', '_messages', '_codes', '_sources', '_extras')
+    KNOWN = {'range', 'severity', 'code', 'source', 'message'}
+
+    def _new_column(self, name):
+        if name == '_severities':
+            # 0 when absent.
+            return array('B')
+        return []
+
+    @classmethod
+    def from_lsp(cls, diagnostics):
+        self = cls()
+        intern = sys.intern
+
+        for diag in diagnostics or ():
+            self._add_range(diag['range'])
+            self._severities.append(diag.get('severity', 0))
+            self._messages.append(diag['message'])
+            self._codes.append(diag.get('code'))
+            source = diag.get('source')
+            self._sources.append(None if source is None else intern(source))
+            extra = None
+            if len(diag) > len(self.KNOWN & diag.keys()):
+                extra = {k: v for k, v in diag.items() if k not in self.KNOWN}
+            self._extras.append(extra)
+
+        return self
+
+    def _item(self, i):
+        return Diagnostic(self._range(i), self._messages[i],
+                          self._severities[i] or None, self._codes[i],
+                          self._sources[i], self._extras[i])
+
+    def filter_severity(self, max_severity):
+        ''' Return the diagnostics at least as severe as MAX_SEVERITY (1 is
+        error, 4 is hint).  '''
+
+        return self._select(i for i, s in enumerate(self._severities)
+                            if s and s <= max_severity)
+
+
+# Model of the result of each method.
+MODELS = {
+    'textDocument/definition': LocationList,
+    'textDocument/declaration': LocationList,
+    'textDocument/implementation': LocationList,
+    'textDocument/typeDefinition': LocationList,
+    'textDocument/references': LocationList,
+    'workspace/symbol': SymbolList,
+}
+
+
+def decode(method_name, result):
+    ''' Convert RESULT, the result of a METHOD_NAME request (or the params
+    of a publishDiagnostics), to its compact model.  '''
+
+    if method_name == 'textDocument/publishDiagnostics':
+        return DiagnosticList.from_lsp(result['diagnostics'])
+
+    if isinstance(result, dict):
+        # definition & co may return a single Location.
+        result = [result]
+
+    return MODELS[method_name].from_lsp(result)
+
+
+def raw_decoder(method_name):
+    ''' Return a decoder for JsonRpc.request (or its result_decoders) that
+    turns the reply to a METHOD_NAME request into its compact model.
+
+    Location lists are built straight from the raw JSON, so the dicts of a
+    huge references reply are never created.  Other results (or replies
+    in an unexpected shape) are decoded by the codec first.  '''
+
+    model = MODELS[method_name]
+
+    def decoder(body, codec, charset):
+        if charset == 'utf-8' and hasattr(model, 'from_raw'):
+            m = _RAW_RESULT_RE.search(body)
+            parsed = m and model.from_raw(body, m.end())
+            if parsed:
+                result, end = parsed
+                # Decode the rest of the message, a few bytes.
+                json_data = codec.loads(bytes(body[:m.end() - 1]) + b'null'
+                                        + bytes(body[end:]), charset)
+                if 'result' in json_data and json_data['result'] is None:
+                    json_data['result'] = result
+                    return json_data
+
+        json_data = codec.loads(body, charset)
+        if 'result' in json_data:
+            json_data['result'] = decode(method_name, json_data['result'])
+
+        return json_data
+
+    return decoder
+
+
+def raw_decoders():
+    ''' Return the raw_decoder of every method of MODELS, to be used as a
+    JsonRpc's result_decoders.  '''
+
+    return {method_name: raw_decoder(method_name)
+            for method_name in MODELS}
@@ -0,0 +1,258 @@
+#
+# Pool of language servers, each owning a shard of the source tree.
+#
+# Documents are routed to the server owning them, workspace/symbol and
+# references are sent to every server and their results merged.  For the
+# multi-project layout, with one clangd per compilation database:
+#
+#   shards = [
+#       server_pool.Shard(root + 'source/libfoo', initialize_params={
+#           'initializationOptions': {
+#               'compilationDatabasePath': root + 'build/libfoo'}}),
+#       server_pool.Shard(root + 'source/bar', initialize_params={
+#           'initializationOptions': {
+#               'compilationDatabasePath': root + 'build/bar'}}),
+#   ]
+#   server_pool.run(interact, shards, cmdline_args='--background-index')
+#
+# The callback gets a ServerPool, which can be used like a JsonRpc.
+#
+
+import json
+import threading
+import time
+import zlib
+
+import common
+import ls_interact as ls
+
+
+class Shard:
+    ''' A server of the pool.  It owns the documents under PREFIX (if None,
+    documents not owned by any other shard are spread by hashing their
+    path).  CMDLINE_ARGS are appended to the server command line and
+    INITIALIZE_PARAMS are merged over the pool's ones.  '''
+
+    def __init__(self, prefix=None, cmdline_args='', initialize_params=None):
+        self.prefix = prefix
+        self.cmdline_args = cmdline_args
+        self.initialize_params = initialize_params or {}
+
+
+def owns(prefix, path):
+    ''' Return whether PATH is PREFIX or under the PREFIX directory.  '''
+
+    prefix = prefix.rstrip('/')
+    return path == prefix or path.startswith(prefix + '/')
+
+
+def merge_results(results):
+    ''' Merge the list results of several servers, dropping duplicates.  '''
+
+    merged = []
+    seen = set()
+
+    for result in results:
+        for item in result or ():
+            key = json.dumps(item, sort_keys=True)
+            if key not in seen:
+                seen.add(key)
+                merged.append(item)
+
+    return merged
+
+
+class PoolPending:
+    ''' OWNER is the JsonRpc of the shard owning the document of a FAN_OUT
+    request, if it's about a document.  '''
+
+    def __init__(self, pendings, merge, owner=None):
+        self.pendings = pendings
+        self.merge = merge
+        self.owner = owner
+
+
+class ServerPool:
+    # Requests whose results may come from any shard.
+    FAN_OUT = {'workspace/symbol', 'textDocument/references'}
+
+    def __init__(self, server, shards, cmdline_args='', log=False,
+                 log_pretty=False, logger=None):
+        self._shards = shards
+        self._procs = []
+        self._rpcs = []
+
+        for shard in shards:
+            proc = common.start_tool('{} {} {}'.format(
+                server, cmdline_args, shard.cmdline_args))
+            # Reader threads let every server make progress while we wait
+            # on one of them.
+            rpc = common.JsonRpc(proc.stdin, proc.stdout, log, log_pretty,
+                                 reader_thread=True, logger=logger)
+            self._procs.append(proc)
+            self._rpcs.append(rpc)
+
+        self._next = 0
+        # Notified each time a shard received a message.
+        self._arrived = threading.Condition()
+        for rpc in self._rpcs:
+            rpc.add_arrival_listener(self._on_arrival)
+
+    def _on_arrival(self):
+        with self._arrived:
+            self._arrived.notify_all()
+
+    @property
+    def rpcs(self):
+        return list(self._rpcs)
+
+    @property
+    def server_capabilities(self):
+        return self._rpcs[0].server_capabilities
+
+    def initialize(self, initialize_params={}):
+        pendings = []
+        for shard, rpc in zip(self._shards, self._rpcs):
+            params = dict(initialize_params)
+            params.update(shard.initialize_params)
+            pendings.append(rpc.request(ls.Initialize(params)))
+
+        for rpc, p in zip(self._rpcs, pendings):
+            rpc.server_capabilities = rpc.wait_for(p).get('capabilities', {})
+            rpc.notify(ls.Initialized())
+
+    def shutdown(self):
+        pendings = [rpc.request(ls.Shutdown()) for rpc in self._rpcs]
+        for rpc, p in zip(self._rpcs, pendings):
+            rpc.wait_for(p)
+            rpc.notify(ls.Exit())
+
+        for proc in self._procs:
+            proc.wait()
+
+    def shard_for(self, path):
+        ''' Return the index of the shard owning PATH.  '''
+
+        best = None
+        for i, shard in enumerate(self._shards):
+            if shard.prefix is not None and owns(shard.prefix, path):
+                if best is None or (len(shard.prefix)
+                                    > len(self._shards[best].prefix)):
+                    best = i
+
+        if best is not None:
+            return best
+
+        unowned = [i for i, shard in enumerate(self._shards)
+                   if shard.prefix is None] or list(range(len(self._shards)))
+        return unowned[zlib.crc32(path.encode()) % len(unowned)]
+
+    def _targets(self, msg):
+        if isinstance(msg, ls.TextDocumentBase):
+            return [self._rpcs[self.shard_for(msg.get_path())]]
+
+        return self._rpcs
+
+    def notify(self, notif):
+        ''' Send NOTIF to the shard owning its document, or to all shards if
+        it's not about a document.  '''
+
+        for rpc in self._targets(notif):
+            rpc.notify(notif)
+
+    def request(self, req, timeout=None):
+        ''' Send REQ to the shard owning its document, or to all of them for
+        FAN_OUT requests.  Other requests not about a document (e.g.
+        workspace/executeCommand) go to the first shard: their results can't
+        be merged.  '''
+
+        owner = None
+        if req.get_method_name() in self.FAN_OUT:
+            targets = self._rpcs
+            if isinstance(req, ls.TextDocumentBase):
+                owner, = self._targets(req)
+        elif isinstance(req, ls.TextDocumentBase):
+            targets = self._targets(req)
+        else:
+            targets = self._rpcs[:1]
+
+        pendings = [(rpc, rpc.request(req, timeout)) for rpc in targets]
+
+        if len(pendings) == 1:
+            return PoolPending(pendings, lambda results: results[0])
+
+        return PoolPending(pendings, merge_results, owner)
+
+    def wait_for(self, pending):
+        ''' Wait for a request sent with request(), or for a notification
+        (JsonRpcPendingMethod) from any shard.  '''
+
+        if isinstance(pending, PoolPending):
+            results = []
+            for rpc, p in pending.pendings:
+                try:
+                    results.append(rpc.wait_for(p))
+                except common.ResponseError:
+                    # Only the owner of the document opened it, the other
+                    # shards may refuse a position in it: they have nothing
+                    # to add.
+                    if pending.owner is None or rpc is pending.owner:
+                        raise
+                    results.append(None)
+
+            return pending.merge(results)
+
+        with self._arrived:
+            while True:
+                # Look at the shards in turn, so none of them is starved.
+                for _ in range(len(self._rpcs)):
+                    rpc = self._rpcs[self._next]
+                    self._next = (self._next + 1) % len(self._rpcs)
+
+                    result = rpc.take(pending)
+                    if result is not None:
+                        return result
+
+                    if rpc.closed is not None:
+                        raise rpc.closed
+
+                self._arrived.wait()
+
+    def request_many(self, reqs, window=None, timeout=None):
+        ''' Like JsonRpc.request_many: keep up to WINDOW requests in flight
+        and return their results in order.  '''
+
+        return common.request_window(
+            reqs, lambda batch: [self.request(req, timeout) for req in batch],
+            self.wait_for, window)
+
+
+def run(callback, shards, cmdline_args="", initialize_params={}):
+    ''' Like ls_interact.run, but start one server per shard in SHARDS and
+    give CALLBACK a ServerPool.  Prints how long the callback took.  '''
+
+    args = ls.parse_args()
+    logger = common.MessageLogger.from_args(args)
+
+    if common.socket_address(args.server) is not None:
+        raise ValueError('a server pool needs a server command line')
+
+    pool = ServerPool(args.server, shards, cmdline_args, args.log,
+                      args.log_pretty, logger)
+    for rpc in pool.rpcs:
+        rpc.codec = common.make_codec(args.json_codec)
+
+    pool.initialize(initialize_params)
+
+    for rpc in pool.rpcs:
+        rpc.default_timeout = args.request_timeout
+
+    start = time.monotonic()
+    callback(pool)
+    print('{} shard(s): {:.3f} s'.format(len(shards),
+                                         time.monotonic() - start))
+
+    pool.shutdown()
+
+    if logger is not None:
+        logger.close()
@@ -0,0 +1,65 @@
+import gzip
+import json
+import threading
+import time
+
+TRACE_VERSION = 1
+
+
+def _open(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+
+    return open(path, mode)
+
+
+class TraceRecorder:
+    ''' Record every message exchanged with a server in a trace file.
+
+    A trace is a header line followed by one line per message:
+
+      [<seconds since start>, "c" or "s", <message>]
+
+    "c" messages were sent by the client, "s" messages by the server.  The
+    message is copied verbatim (it is already JSON), so recording doesn't
+    re-encode anything.  The file is gzipped if its name ends with .gz.
+
+    The header's "start" is the time.monotonic() value of time 0.  '''
+
+    def __init__(self, path):
+        self._f = _open(path, 'wb')
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+
+        header = {'version': TRACE_VERSION, 'kind': 'ls-interact-trace',
+                  'clock': 'monotonic', 'start': self._start}
+        self._f.write(json.dumps(header).encode() + b'\n')
+
+    def record(self, body, sender):
+        t = time.monotonic() - self._start
+        direction = b'c' if sender == 'client' else b's'
+
+        # Newlines can only be whitespace in a JSON text, keep one message
+        # per line.
+        body = body.replace(b'\n', b' ').replace(b'\r', b' ')
+        line = b'[%.6f,"%s",%s]\n' % (t, direction, body)
+
+        with self._lock:
+            self._f.write(line)
+
+    def close(self):
+        with self._lock:
+            self._f.close()
+
+
+def read_trace(path):
+    ''' Return the list of (time, direction, message) tuples of the trace at
+    PATH.  '''
+
+    with _open(path, 'rb') as f:
+        header = json.loads(f.readline())
+        if header.get('version') != TRACE_VERSION:
+            raise ValueError('unsupported trace version: {}'.format(
+                header.get('version')))
+
+        return [tuple(json.loads(line)) for line in f if line.strip()]
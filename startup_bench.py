@@ -0,0 +1,169 @@
+#
+# Benchmark how long a language server takes to become useful: process
+# spawn, the initialize round-trip, the first diagnostics for the opened
+# files and the end of the work done progress (background indexing).
+#
+# Each run is done cold (index cache wiped) and warm (cache left by the cold
+# run), and the medians are compared.  For clangd, the index cache is the
+# .cache/clangd/index directory of the project:
+#
+#   python3 startup_bench.py --root multi-project/source \
+#       --index-cache multi-project/source/.cache/clangd/index \
+#       --open multi-project/source/bar/bar.cpp --runs 3 \
+#       "/path/to/clangd --background-index"
+#
+# Use --json to save all the measurements, e.g. to compare two builds.
+#
+
+import argparse
+import json
+import os
+import shutil
+import time
+
+import common
+import diagnostics
+import documents
+import ls_interact as ls
+import progress
+from stats import percentile
+
+PHASES = ['spawn', 'initialize', 'first_diagnostics', 'all_diagnostics',
+          'index_ready']
+
+
+def measure(args):
+    ''' Start the server, measure the time of each phase, since the spawn,
+    and shut it down.  '''
+
+    times = {}
+    start = time.monotonic()
+    server = common.start_tool(args.server)
+    times['spawn'] = time.monotonic() - start
+
+    json_rpc = common.JsonRpc(server.stdin, server.stdout, False, False)
+    tracker = progress.ProgressTracker(json_rpc)
+    diags = diagnostics.DiagnosticsStore(json_rpc)
+
+    initialize_params = {
+        'processId': os.getpid(),
+        'rootUri': 'file://' + os.path.abspath(args.root),
+        'capabilities': {'window': {'workDoneProgress': True}},
+    }
+    p = json_rpc.request(ls.Initialize(initialize_params))
+    r = json_rpc.wait_for(p)
+    times['initialize'] = time.monotonic() - start
+    json_rpc.server_capabilities = r.get('capabilities', {})
+    json_rpc.notify(ls.Initialized())
+
+    paths = [os.path.abspath(path) for path in args.open]
+    docs = documents.DocumentStore(json_rpc, diags)
+    for path in paths:
+        docs.open(path)
+
+    if paths:
+        diags.wait_for_any(paths, args.timeout)
+        times['first_diagnostics'] = time.monotonic() - start
+        diags.wait_for_diagnostics(paths, args.timeout)
+        times['all_diagnostics'] = time.monotonic() - start
+
+    end = tracker.wait_until_idle(args.quiet, args.timeout)
+    if end is not None:
+        times['index_ready'] = end - start
+
+    p = json_rpc.request(ls.Shutdown())
+    json_rpc.wait_for(p)
+    json_rpc.notify(ls.Exit())
+    server.wait()
+
+    tokens = [{
+        'token': entry['token'],
+        'title': entry['title'],
+        'begin': entry['begin'] and entry['begin'] - start,
+        'end': entry['end'] and entry['end'] - start,
+    } for entry in tracker.timings()]
+
+    return {'times': times, 'progress': tokens}
+
+
+def median(runs, phase):
+    return percentile(sorted(run['times'][phase] for run in runs
+                             if phase in run['times']), 50)
+
+
+def format_ms(value):
+    if value is None:
+        return '{:>10}'.format('-')
+
+    return '{:10.1f}'.format(value * 1000)
+
+
+def format_report(results):
+    lines = ['{:18}  {:>10}  {:>10}  {:>10}'.format(
+        'phase (ms)', 'cold', 'warm', 'warm-cold')]
+
+    for phase in PHASES:
+        cold = median(results['cold'], phase)
+        warm = median(results['warm'], phase)
+        diff = None
+        if cold is not None and warm is not None:
+            diff = warm - cold
+
+        lines.append('{:18}  {}  {}  {}'.format(
+            phase, format_ms(cold), format_ms(warm), format_ms(diff)))
+
+    return '\n'.join(lines)
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('server', help='command line of the server')
+    argparser.add_argument('--root', default='.',
+                           help='root of the project (default: .)')
+    argparser.add_argument('--open', metavar='FILE', action='append',
+                           default=[],
+                           help='open FILE and wait for its diagnostics '
+                                '(may be repeated)')
+    argparser.add_argument('--index-cache', metavar='DIR',
+                           help='index cache of the server, wiped before '
+                                'each cold run')
+    argparser.add_argument('--runs', type=int, default=1,
+                           help='number of cold and of warm runs')
+    argparser.add_argument('--quiet', metavar='SECONDS', type=float,
+                           default=1.0,
+                           help=('the index is ready once no progress was '
+                                 'reported for this long (default: '
+                                 '%(default)s)'))
+    argparser.add_argument('--timeout', metavar='SECONDS', type=float,
+                           default=600,
+                           help='give up waiting for a phase after this long')
+    argparser.add_argument('--json', metavar='FILE',
+                           help='save all the measurements as JSON in FILE')
+    args = argparser.parse_args()
+
+    if args.index_cache is None:
+        print('warning: no --index-cache, cold and warm runs will be alike')
+
+    results = {'cold': [], 'warm': []}
+
+    for i in range(args.runs):
+        # A warm run reuses the cache left by the cold run before it.
+        for mode in ('cold', 'warm'):
+            if mode == 'cold' and args.index_cache is not None:
+                shutil.rmtree(args.index_cache, ignore_errors=True)
+
+            run = measure(args)
+            results[mode].append(run)
+            print('run {} {}: {}'.format(i + 1, mode, ', '.join(
+                '{} {:.3f} s'.format(phase, run['times'][phase])
+                for phase in PHASES if phase in run['times'])))
+
+    print(format_report(results))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+import collections
+import json
+import math
+import time
+
+
+def percentile(values, p):
+    ''' Nearest-rank percentile of the sorted list VALUES.  '''
+
+    if not values:
+        return None
+
+    rank = max(math.ceil(p / 100 * len(values)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+class LatencyStats:
+    ''' Record the timing of every request, keyed by method.
+
+    For each request we keep the time it was sent, the time the first byte
+    of its reply arrived and the time the reply was fully decoded, as well
+    as the request and reply sizes.
+
+    For requests cancelled because they timed out, we instead keep the time
+    between the cancellation and the server's acknowledgement (its reply to
+    the cancelled request).
+
+    Send times are time.monotonic() values.  '''
+
+    def __init__(self):
+        # Requests sent but not replied to yet: id -> (method, time, size).
+        self._in_flight = {}
+        self._samples = collections.defaultdict(list)
+        # If not None, the samples of the requests replied to are also
+        # added to it, by id.  Whoever sets it should pop them as it goes.
+        self.by_id = None
+        # Cancelled requests not acknowledged yet: id -> cancel time.
+        self._cancelled = {}
+        self._timeouts = collections.Counter()
+        self._cancel_acks = collections.defaultdict(list)
+
+    def on_send(self, the_id, method_name, size):
+        self._in_flight[the_id] = (method_name, time.monotonic(), size)
+
+    def on_cancel(self, the_id):
+        sent = self._in_flight.get(the_id)
+        if sent is None:
+            return
+
+        self._cancelled[the_id] = time.monotonic()
+        self._timeouts[sent[0]] += 1
+
+    def on_reply(self, the_id, first_byte_time, size):
+        ''' Record the reply to THE_ID, return its sample (None if it's not
+        a request we timed).  '''
+
+        decoded_time = time.monotonic()
+
+        sent = self._in_flight.pop(the_id, None)
+        if sent is None:
+            return
+
+        method_name, send_time, request_size = sent
+
+        cancel_time = self._cancelled.pop(the_id, None)
+        if cancel_time is not None:
+            self._cancel_acks[method_name].append(decoded_time - cancel_time)
+            return None
+        if first_byte_time is None:
+            first_byte_time = decoded_time
+        first_byte_time = max(first_byte_time, send_time)
+
+        sample = {
+            'id': the_id,
+            'sent': send_time,
+            'first_byte': first_byte_time - send_time,
+            'total': decoded_time - send_time,
+            'request_size': request_size,
+            'reply_size': size,
+        }
+        self._samples[method_name].append(sample)
+        if self.by_id is not None:
+            self.by_id[the_id] = sample
+
+        return sample
+
+    def summary(self):
+        ''' Return a JSON-serializable summary, by method.  Times are in
+        milliseconds, sizes in bytes.  '''
+
+        result = {}
+
+        def distribution(values):
+            values = sorted(values)
+            return {
+                'p50': percentile(values, 50),
+                'p90': percentile(values, 90),
+                'p99': percentile(values, 99),
+                'max': values[-1] if values else None,
+            }
+
+        methods = set(self._samples) | set(self._timeouts)
+
+        for method_name in sorted(methods):
+            samples = self._samples.get(method_name, [])
+            entry = {
+                'count': len(samples),
+                'timeouts': self._timeouts[method_name],
+            }
+
+            for what in ('first_byte', 'total'):
+                entry[what] = distribution(s[what] * 1000 for s in samples)
+
+            for what in ('request_size', 'reply_size'):
+                values = [s[what] for s in samples]
+                entry[what] = {
+                    'total': sum(values),
+                    'max': max(values, default=0),
+                }
+
+            acks = self._cancel_acks.get(method_name)
+            if acks:
+                entry['cancel_ack'] = distribution(a * 1000 for a in acks)
+
+            result[method_name] = entry
+
+        return result
+
+    def requests(self):
+        ''' Return the samples of all the requests replied to, with their
+        method, in the order they were sent.  Times are in seconds.  '''
+
+        requests = [dict(sample, method=method_name)
+                    for method_name, samples in self._samples.items()
+                    for sample in samples]
+        requests.sort(key=lambda sample: sample['sent'])
+
+        return requests
+
+    def to_json(self):
+        return json.dumps({
+            'clock': 'monotonic',
+            'methods': self.summary(),
+            'requests': self.requests(),
+        }, indent=4)
+
+    def format_table(self):
+        rows = [('method', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms',
+                 '1st byte p50', 'req bytes', 'reply bytes', 'max reply',
+                 'timeouts', 'cancel ack p50')]
+
+        def ms(value):
+            return '-' if value is None else '{:.2f}'.format(value)
+
+        for method_name, entry in self.summary().items():
+            total = entry['total']
+            cancel_ack = entry.get('cancel_ack', {}).get('p50')
+            rows.append((
+                method_name,
+                str(entry['count']),
+                ms(total['p50']),
+                ms(total['p90']),
+                ms(total['p99']),
+                ms(total['max']),
+                ms(entry['first_byte']['p50']),
+                str(entry['request_size']['total']),
+                str(entry['reply_size']['total']),
+                str(entry['reply_size']['max']),
+                str(entry['timeouts']),
+                ms(cancel_ack),
+            ))
+
+        widths = [max(len(row[i]) for row in rows)
+                  for i in range(len(rows[0]))]
+
+        lines = []
+        for row in rows:
+            cells = [row[0].ljust(widths[0])]
+            cells += [cell.rjust(w) for cell, w in zip(row[1:], widths[1:])]
+            lines.append('  '.join(cells))
+
+        return '\n'.join(lines)
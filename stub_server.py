@@ -0,0 +1,364 @@
+#
+# Synthetic language server, to stress the client side.
+#
+# It answers initialize, textDocument/definition, textDocument/references,
+# workspace/symbol and textDocument/hover with synthetic results of
+# configurable size, publishes diagnostics for opened/changed documents and
+# can flood the client with notifications or pretend to index the project.
+# For example:
+#
+#   python3 some_script.py "python3 stub_server.py --references 100000 --storm-rate 5000"
+#
+# Use --port to listen on a TCP port, and pass :<port> to the script (or
+# --unix and unix:<path> for a Unix domain socket).
+#
+
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+import common
+
+
+def make_range(line, col):
+    return {
+        'start': {'line': line, 'character': col},
+        'end': {'line': line, 'character': col + 8},
+    }
+
+
+def make_locations(count):
+    return [{
+        'uri': 'file:///stub/src/file{}.cpp'.format(i % 100),
+        'range': make_range(i // 100, i % 80),
+    } for i in range(count)]
+
+
+def make_symbols(count):
+    return [{
+        'name': 'symbol{}'.format(i),
+        'kind': 12,
+        'location': {
+            'uri': 'file:///stub/src/file{}.cpp'.format(i % 100),
+            'range': make_range(i // 100, 0),
+        },
+        'containerName': 'ns{}'.format(i % 10),
+    } for i in range(count)]
+
+
+def make_diagnostics(count):
+    return [{
+        'range': make_range(i, 0),
+        'severity': 2,
+        'source': 'stub',
+        'message': 'synthetic diagnostic {}'.format(i),
+    } for i in range(count)]
+
+
+class StubServer:
+    def __init__(self, args, inp, output):
+        self._args = args
+        self._input = inp
+        self._output = output
+        self._framer = common.MessageFramer()
+        self._write_lock = threading.Lock()
+        self._storm_stop = threading.Event()
+        # Ids of the --slow-method requests not replied to yet.
+        self._slow_pending = set()
+        # URIs of the open documents.
+        self._open = set()
+
+        # Results are the same for every request, encode them once.
+        self._results = {
+            'textDocument/definition':
+                json.dumps(make_locations(args.definitions)).encode(),
+            'textDocument/references':
+                json.dumps(make_locations(args.references)).encode(),
+            'workspace/symbol':
+                json.dumps(make_symbols(args.symbols)).encode(),
+            'textDocument/hover': json.dumps({
+                'contents': {'kind': 'plaintext',
+                             'value': 'x' * args.hover_size},
+            }).encode(),
+        }
+
+    def _write(self, body):
+        header = 'Content-Length: {}\r\n\r\n'.format(len(body)).encode()
+        with self._write_lock:
+            self._output.write(header + body)
+            self._output.flush()
+
+    def _reply(self, the_id, result_bytes):
+        self._write(b'{"jsonrpc":"2.0","id":' + json.dumps(the_id).encode()
+                    + b',"result":' + result_bytes + b'}')
+
+    def _reply_later(self, the_id, result_bytes):
+        ''' Reply to a --slow-method request after --slow-delay, unless it
+        was cancelled in the mean time.  '''
+
+        key = json.dumps(the_id)
+        with self._write_lock:
+            self._slow_pending.add(key)
+
+        def reply():
+            with self._write_lock:
+                if key not in self._slow_pending:
+                    return
+                self._slow_pending.discard(key)
+
+            self._reply(the_id, result_bytes)
+
+        timer = threading.Timer(self._args.slow_delay, reply)
+        timer.daemon = True
+        timer.start()
+
+    def _reply_partial(self, the_id, method_name, token):
+        ''' Send the result in --partial-results sized chunks as $/progress
+        notifications, then an empty reply.  '''
+
+        if method_name == 'workspace/symbol':
+            result = make_symbols(self._args.symbols)
+        else:
+            result = make_locations(self._args.references)
+
+        size = self._args.partial_results
+        for i in range(0, len(result), size):
+            self._notify('$/progress', {
+                'token': token,
+                'value': result[i:i + size],
+            })
+
+        self._reply(the_id, b'[]')
+
+    def _error(self, the_id, code, message):
+        self._write(json.dumps({
+            'jsonrpc': '2.0',
+            'id': the_id,
+            'error': {'code': code, 'message': message},
+        }).encode())
+
+    def _cancel(self, the_id):
+        key = json.dumps(the_id)
+        with self._write_lock:
+            if key not in self._slow_pending:
+                return
+            self._slow_pending.discard(key)
+
+        self._error(the_id, -32800, 'Request cancelled')
+
+    def _notify(self, method_name, params):
+        self._write(json.dumps({
+            'jsonrpc': '2.0',
+            'method': method_name,
+            'params': params,
+        }).encode())
+
+    def _publish_diagnostics(self, text_document):
+        params = {
+            'uri': text_document['uri'],
+            'diagnostics': make_diagnostics(self._args.diagnostics),
+        }
+        if 'version' in text_document:
+            params['version'] = text_document['version']
+
+        self._notify('textDocument/publishDiagnostics', params)
+
+    def _storm(self):
+        ''' Send notifications at --storm-rate per second, alternating
+        between publishDiagnostics and $/progress.  '''
+
+        period = 1.0 / self._args.storm_rate
+        diags = make_diagnostics(self._args.diagnostics)
+        n = 0
+        next_time = time.monotonic()
+
+        while not self._storm_stop.is_set():
+            if n % 2 == 0:
+                self._notify('textDocument/publishDiagnostics', {
+                    'uri': 'file:///stub/src/storm{}.cpp'.format(n % 100),
+                    'diagnostics': diags,
+                })
+            else:
+                self._notify('$/progress', {
+                    'token': 'stub-storm',
+                    'value': {'kind': 'report', 'message': str(n)},
+                })
+            n += 1
+
+            next_time += period
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    def _index(self):
+        ''' Pretend to index the project for --index-time seconds,
+        reporting it with work done progress.  '''
+
+        token = 'stub-index'
+        self._write(json.dumps({
+            'jsonrpc': '2.0',
+            'id': 'create-' + token,
+            'method': 'window/workDoneProgress/create',
+            'params': {'token': token},
+        }).encode())
+        self._notify('$/progress', {
+            'token': token,
+            'value': {'kind': 'begin', 'title': 'indexing', 'percentage': 0},
+        })
+
+        steps = 10
+        for i in range(1, steps):
+            time.sleep(self._args.index_time / steps)
+            self._notify('$/progress', {
+                'token': token,
+                'value': {'kind': 'report', 'percentage': i * 100 // steps},
+            })
+
+        time.sleep(self._args.index_time / steps)
+        self._notify('$/progress', {
+            'token': token,
+            'value': {'kind': 'end'},
+        })
+
+    def _receive_one(self):
+        body = self._framer.next_body()
+
+        while body is None:
+            chunk = common.read_chunk(self._input, self._framer.READ_SIZE)
+            if not chunk:
+                raise EOFError('client closed the connection')
+
+            self._framer.feed(chunk)
+            body = self._framer.next_body()
+
+        return json.loads(body.decode(self._framer.last_charset))
+
+    def run(self):
+        while True:
+            msg = self._receive_one()
+            method_name = msg.get('method')
+            params = msg.get('params') or {}
+
+            if method_name == 'exit':
+                return
+
+            if method_name == 'initialized':
+                if self._args.storm_rate > 0:
+                    threading.Thread(target=self._storm, daemon=True).start()
+                if self._args.index_time > 0:
+                    threading.Thread(target=self._index, daemon=True).start()
+            elif method_name in ('textDocument/didOpen',
+                                 'textDocument/didChange'):
+                self._open.add(params['textDocument']['uri'])
+                self._publish_diagnostics(params['textDocument'])
+            elif method_name == 'textDocument/didClose':
+                self._open.discard(params['textDocument']['uri'])
+            elif method_name == '$/cancelRequest':
+                self._cancel(params['id'])
+
+            if 'id' not in msg or method_name is None:
+                continue
+
+            if method_name == 'initialize':
+                result = json.dumps({'capabilities': {
+                    'textDocumentSync': 2,
+                    'definitionProvider': True,
+                    'referencesProvider': True,
+                    'workspaceSymbolProvider': True,
+                    'hoverProvider': True,
+                }}).encode()
+            elif method_name == 'shutdown':
+                self._storm_stop.set()
+                result = b'null'
+            else:
+                result = self._results.get(method_name, b'null')
+
+            uri = (params.get('textDocument') or {}).get('uri')
+            if (self._args.require_open and uri is not None
+                    and uri not in self._open):
+                # What clangd says.
+                self._error(msg['id'], -32602,
+                            'trying to get AST for non-added document')
+            elif (self._args.partial_results > 0
+                    and 'partialResultToken' in params
+                    and method_name in ('textDocument/references',
+                                        'workspace/symbol')):
+                self._reply_partial(msg['id'], method_name,
+                                    params['partialResultToken'])
+            elif method_name == self._args.slow_method:
+                self._reply_later(msg['id'], result)
+            else:
+                self._reply(msg['id'], result)
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--definitions', type=int, default=1,
+                           help='number of locations per definition result')
+    argparser.add_argument('--references', type=int, default=100,
+                           help='number of locations per references result')
+    argparser.add_argument('--symbols', type=int, default=100,
+                           help=('number of symbols per workspace/symbol '
+                                 'result'))
+    argparser.add_argument('--hover-size', type=int, default=100,
+                           help='size of the hover text')
+    argparser.add_argument('--diagnostics', type=int, default=1,
+                           help='number of diagnostics per publishDiagnostics')
+    argparser.add_argument('--storm-rate', type=float, default=0,
+                           help=('notifications per second sent after '
+                                 'initialized, until shutdown (0 = none)'))
+    argparser.add_argument('--slow-method', metavar='METHOD',
+                           help=('reply to METHOD requests only after '
+                                 '--slow-delay seconds, or when cancelled'))
+    argparser.add_argument('--slow-delay', type=float, default=10,
+                           help='delay of the --slow-method replies')
+    argparser.add_argument('--index-time', type=float, default=0,
+                           help=('pretend to index for this many seconds '
+                                 'after initialized, reporting work done '
+                                 'progress (0 = no indexing)'))
+    argparser.add_argument('--partial-results', metavar='N', type=int,
+                           default=0,
+                           help=('send references and workspace/symbol '
+                                 'results in chunks of N as partial results, '
+                                 'when the client asks for them'))
+    argparser.add_argument('--require-open', action='store_true',
+                           help=('answer requests about documents that are '
+                                 'not open with an error, like clangd'))
+    argparser.add_argument('--port', type=int,
+                           help='listen on this TCP port instead of stdio')
+    argparser.add_argument('--unix', metavar='PATH',
+                           help=('listen on this Unix domain socket instead '
+                                 'of stdio'))
+    args = argparser.parse_args()
+
+    listener = None
+    if args.port is not None:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(('127.0.0.1', args.port))
+    elif args.unix is not None:
+        if os.path.exists(args.unix):
+            os.unlink(args.unix)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(args.unix)
+
+    if listener is not None:
+        listener.listen(1)
+        conn, _ = listener.accept()
+        f = conn.makefile(mode='rwb')
+        server = StubServer(args, f, f)
+    else:
+        server = StubServer(args, sys.stdin.buffer, sys.stdout.buffer)
+
+    try:
+        server.run()
+    except (EOFError, BrokenPipeError):
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+#
+# Exercise the client against stub_server.py (and replay_server.py), so it
+# can be tested without a real language server:
+#
+#   python3 test_stub.py
+#
+# Each scenario runs ls_interact.run against a fresh stub: pipelined
+# requests, reader thread futures, timeouts and cancellation, partial result
+# streams, document changes, notification storms and the response cache.
+# The last session is recorded and replayed with replay_server.py, which
+# must give the same results.
+#
+
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import Future
+
+import common
+import diagnostics
+import documents
+import ls_interact as ls
+import response_cache
+import stats
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STUB = 'python3 {} --references 1000 --partial-results 100 ' \
+       '--slow-method workspace/symbol --slow-delay 5'.format(
+           os.path.join(HERE, 'stub_server.py'))
+PATH = os.path.join(HERE, 'cpp-test', 'src', 'first.cpp')
+
+
+class NotifyRecorder:
+    ''' Pass the notifications on to JSON_RPC, keeping them in SENT.  '''
+
+    def __init__(self, json_rpc):
+        self._json_rpc = json_rpc
+        self.sent = []
+
+    def __getattr__(self, name):
+        return getattr(self._json_rpc, name)
+
+    def notify(self, notif):
+        self.sent.append(notif)
+        return self._json_rpc.notify(notif)
+
+
+def check_request_many(json_rpc):
+    reqs = [ls.Hover(PATH, 1, i) for i in range(1, 51)]
+    reqs += [ls.FindReferences(PATH, 1, 1), ls.GotoDefinition(PATH, 1, 1)]
+
+    for window in (None, 1, 8):
+        r = json_rpc.request_many(reqs, window=window)
+        assert len(r) == len(reqs)
+        assert all(len(h['contents']['value']) == 100 for h in r[:50])
+        assert len(r[50]) == 1000
+        assert len(r[51]) == 1
+
+    return len(r[50])
+
+
+def check_futures(json_rpc):
+    fut = json_rpc.request(ls.FindReferences(PATH, 1, 1))
+    assert isinstance(fut, Future)
+    assert len(fut.result(timeout=5)) == 1000
+    assert fut.reply_time >= fut.sent_time
+
+    futs = [json_rpc.request(ls.Hover(PATH, 1, i)) for i in range(1, 21)]
+    assert all(f.result(timeout=5) is not None for f in futs)
+
+
+def check_timeout(json_rpc):
+    p = json_rpc.request(ls.WorkspaceSymbol('slow'), timeout=0.2)
+    try:
+        json_rpc.wait_for(p)
+    except common.RequestTimeout as e:
+        assert e.method_name == 'workspace/symbol'
+    else:
+        assert False, 'no RequestTimeout'
+
+    # The server acknowledges the cancellation with an error reply, which
+    # must not get in the way of the next requests.
+    r = json_rpc.request_many([ls.Hover(PATH, 1, 1)] * 5)
+    assert len(r) == 5
+
+    # The deadline fires while waiting for something else.
+    saved, json_rpc.stats = json_rpc.stats, stats.LatencyStats()
+    p = json_rpc.request(ls.WorkspaceSymbol('slow'), timeout=0.2)
+    json_rpc.wait_until(lambda: False, 0.5)
+    assert json_rpc.stats.summary()['workspace/symbol']['timeouts'] == 1
+    json_rpc.stats = saved
+
+
+def check_stream(json_rpc):
+    chunks = list(json_rpc.stream(ls.FindReferences(PATH, 1, 1)))
+    assert len(chunks) == 10
+    assert sum(len(chunk) for chunk in chunks) == 1000
+
+    # Stop after the first chunk: the rest is dropped, the next request
+    # works.
+    for chunk in json_rpc.stream(ls.FindReferences(PATH, 1, 1)):
+        break
+    assert len(json_rpc.wait_for(json_rpc.request(
+        ls.GotoDefinition(PATH, 1, 1)))) == 1
+
+    return [len(chunk) for chunk in chunks]
+
+
+def check_stream_error(json_rpc):
+    # The stub refuses requests about documents that aren't open: the
+    # request was answered, there is nothing to cancel.
+    cancels = []
+    json_rpc.send_cancel = cancels.append
+    try:
+        list(json_rpc.stream(ls.FindReferences(PATH, 1, 1)))
+    except common.ResponseError as e:
+        assert e.code == -32602, e.code
+    else:
+        assert False, 'no ResponseError'
+    del json_rpc.send_cancel
+    assert cancels == [], cancels
+
+
+def check_documents(json_rpc):
+    recorder = NotifyRecorder(json_rpc)
+    diags = diagnostics.DiagnosticsStore(json_rpc)
+    docs = documents.DocumentStore(recorder, diags)
+
+    text = 'int foo;\nint bar;\n'
+    docs.open(PATH, text)
+    diags.wait_for_diagnostics([PATH], 5)
+
+    docs.change(PATH, 'int foo;\nint baz;\n')
+    docs.change(PATH, 'int foo;\nint baz;\nint qux;\n')
+    diags.wait_for_diagnostics([PATH], 5)
+    assert diags.version(PATH) == 3
+    assert docs.get(PATH).version == 3
+
+    # Incremental changes: only the edited part is sent.
+    changes = recorder.sent[-1].get_params()['contentChanges']
+    assert changes == [{
+        'range': {'start': {'line': 2, 'character': 0},
+                  'end': {'line': 2, 'character': 0}},
+        'text': 'int qux;\n',
+    }], changes
+
+    # Without the text, changes are sent in full.
+    docs.close(PATH)
+    docs.open(PATH, text, keep_text=False)
+    docs.change(PATH, 'int foo;\n')
+    assert docs.get(PATH).text is None
+    changes = recorder.sent[-1].get_params()['contentChanges']
+    assert changes == [{'text': 'int foo;\n'}], changes
+    docs.close(PATH)
+
+    # Nor to a server that doesn't say it supports incremental changes.
+    recorder.server_capabilities = {}
+    docs = documents.DocumentStore(recorder, diags)
+    docs.open(PATH, text)
+    docs.change(PATH, 'int foo;\n')
+    changes = recorder.sent[-1].get_params()['contentChanges']
+    assert changes == [{'text': 'int foo;\n'}], changes
+    docs.close(PATH)
+
+    return diags.version(PATH)
+
+
+def check_handlers(json_rpc):
+    def fail(params):
+        raise ValueError('handler bug')
+
+    # The error is sent to the server as the reply, the next requests work.
+    json_rpc.on_request('test/fail', fail)
+    json_rpc.dispatch({'jsonrpc': '2.0', 'id': 'fail-1',
+                       'method': 'test/fail', 'params': {}})
+    assert len(json_rpc.wait_for(json_rpc.request(
+        ls.GotoDefinition(PATH, 1, 1)))) == 1
+
+
+def check_storm(json_rpc):
+    # Nobody takes these notifications: only the last max_queued are kept.
+    json_rpc.max_queued = 50
+    end = time.monotonic() + 0.5
+    while time.monotonic() < end:
+        json_rpc.pump(0.1)
+
+    assert len(json_rpc.take_notifications('$/progress')) == 50
+    assert len(json_rpc.request_many([ls.Hover(PATH, 1, 1)] * 5)) == 5
+
+
+def check_cache(cache):
+    assert isinstance(cache, response_cache.ResponseCache)
+    docs = documents.DocumentStore(cache)
+    docs.open(PATH, 'int foo;\n')
+
+    reqs = [ls.Hover(PATH, 1, i) for i in range(1, 11)]
+    first = cache.gather([cache.request(req) for req in reqs])
+    again = cache.gather([cache.request(req) for req in reqs])
+    assert first == again
+    assert cache.summary()['methods']['textDocument/hover']['hits'] == 10
+
+    # Entries are sized after the reply body, not re-encoded.
+    p = cache.request(ls.FindReferences(PATH, 1, 1))
+    cache.wait_for(p)
+    assert p.size > 1000 * len('"uri"'), p.size
+
+    # A change forgets the replies about the document.
+    docs.change(PATH, 'int bar;\n')
+    assert cache.summary()['entries'] == 0
+    assert len(cache.request_many(reqs, window=4)) == 10
+    docs.close(PATH)
+
+
+def run(interact, server, *args):
+    ''' Run INTERACT with ls_interact.run, as if given SERVER and ARGS on
+    the command line.  '''
+
+    print('-- {} {}'.format(interact.__name__, ' '.join(args)))
+    saved = sys.argv
+    sys.argv = [saved[0], server] + list(args)
+    try:
+        ls.run(interact)
+    finally:
+        sys.argv = saved
+
+
+def main():
+    results = {}
+
+    def synchronous(json_rpc):
+        check_request_many(json_rpc)
+        check_timeout(json_rpc)
+        check_stream(json_rpc)
+        check_documents(json_rpc)
+
+    def storm(json_rpc):
+        check_storm(json_rpc)
+
+    def errors(json_rpc):
+        check_stream_error(json_rpc)
+
+    def cached(cache):
+        check_cache(cache)
+        check_request_many(cache)
+        check_stream(cache)
+
+    def reader_thread(json_rpc):
+        check_futures(json_rpc)
+        check_handlers(json_rpc)
+        check_request_many(json_rpc)
+        check_timeout(json_rpc)
+        check_stream(json_rpc)
+        check_documents(json_rpc)
+
+    def replayable(json_rpc):
+        # No timeouts: they depend on the timing of the session.
+        results[json_rpc.recorder is not None] = (
+            check_request_many(json_rpc), check_stream(json_rpc),
+            check_documents(json_rpc))
+
+    run(synchronous, STUB)
+    run(storm, STUB + ' --storm-rate 5000')
+    run(errors, STUB + ' --require-open')
+    run(errors, STUB + ' --require-open', '--reader-thread')
+    run(cached, STUB, '--response-cache', '1')
+    run(reader_thread, STUB, '--reader-thread')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        trace = os.path.join(tmp, 'stub.trace.gz')
+        run(replayable, STUB, '--record', trace)
+        run(replayable, 'python3 {} --speed 0 {}'.format(
+            os.path.join(HERE, 'replay_server.py'), trace))
+
+    assert results[True] == results[False], results
+    print('all good')
+
+
+if __name__ == '__main__':
+    main()